@@ -4,8 +4,15 @@ from docx import Document
 from docx.shared import Inches, Pt, RGBColor
 import httpx
 from bs4 import BeautifulSoup
+import io
 import json
+import math
 import re
+import time
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from contextlib import contextmanager
 import matplotlib
 matplotlib.use('Agg') 
 import matplotlib.pyplot as plt
@@ -17,15 +24,225 @@ from reportlab.lib.styles import getSampleStyleSheet
 import fitz 
 
 from report_formats import get_template_instructions
+import database
+import metrics
+import tracing
 
 # --- 2-LAYER MODEL CONFIGURATION ---
 SMART_MODEL = "amazon/nova-2-lite-v1:free"
 BACKUP_MODEL = "meta-llama/llama-3.3-70b-instruct:free"
 
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+SERPAPI_URL = "https://serpapi.com"
+
 SEARCH_RESULTS_COUNT = 10
 MAX_RESULTS_TO_SCRAPE = 3
 WORDS_PER_PAGE = 400
 
+# --- LATENCY BUDGET ---
+LLM_TIMEOUT = 60.0
+SCRAPE_TIMEOUT = 15.0
+MIN_CALL_TIMEOUT = 20.0
+SCRAPE_BUDGET_SHARE = 0.25   # scraping may eat at most this share of the budget
+MIN_SCRAPE_TIMEOUT = 5.0     # below this a scrape rarely finishes, so the URL is skipped instead
+CHART_MIN_SECONDS = 120      # skip the chart when less than this is left before writing
+CRITIQUE_MIN_SECONDS = 90    # per-section headroom needed to afford critique_and_refine
+SECTION_SECONDS = 45         # rough cost of writing one full-length section
+MIN_SECTION_WORDS = 150
+SECTION_REGEN_SECONDS = 180 # budget for regenerating one section of a stored report
+
+class ReportBudget:
+    """Wall-clock deadline for one report. Stages consult it and degrade instead of overrunning."""
+
+    def __init__(self, seconds: float, deadline: float = None):
+        self.total = float(seconds)
+        # An explicit deadline lets subtasks on other workers share the parent report's budget.
+        self.deadline = deadline or time.time() + self.total
+        self.degradations = []
+
+    def remaining(self) -> float:
+        return max(0.0, self.deadline - time.time())
+
+    def timeout(self, default: float) -> float:
+        return min(default, max(MIN_CALL_TIMEOUT, self.remaining()))
+
+    def degrade(self, name: str):
+        if name not in self.degradations:
+            print(f"   [budget] Degrading: {name} ({self.remaining():.0f}s left)")
+            self.degradations.append(name)
+
+_current_budget = contextvars.ContextVar("report_budget", default=None)
+
+def current_budget():
+    return _current_budget.get()
+
+@contextmanager
+def report_budget(seconds: float, deadline: float = None):
+    budget = ReportBudget(seconds, deadline)
+    token = _current_budget.set(budget)
+    try:
+        yield budget
+    finally:
+        _current_budget.reset(token)
+
+# --- HTTP CLIENTS ---
+# One pooled client per purpose and worker process, so TLS connections to OpenRouter stay
+# warm between calls. The clients are shared by every report in the process: never close them.
+_http_clients = {}
+_serpapi_clients = {}
+
+def get_http_client(purpose: str = "llm") -> httpx.Client:
+    client = _http_clients.get(purpose)
+    if client is None or client.is_closed:
+        client = httpx.Client(
+            follow_redirects=(purpose == "scrape"),
+            limits=httpx.Limits(max_keepalive_connections=10, keepalive_expiry=120.0)
+        )
+        _http_clients[purpose] = client
+    return client
+
+def get_serpapi_client(api_key: str) -> serpapi.Client:
+    if api_key not in _serpapi_clients:
+        _serpapi_clients[api_key] = serpapi.Client(api_key=api_key)
+    return _serpapi_clients[api_key]
+
+# --- CANCELLATION ---
+CANCEL_POLL_SECONDS = 2.0
+
+class ReportCancelled(Exception):
+    """Raised inside the pipeline once the report's task has been cancelled."""
+
+class CancelToken:
+    """Cooperative cancellation flag for one report task, polled from the database at most every CANCEL_POLL_SECONDS."""
+
+    def __init__(self, task_id: str):
+        self.task_id = task_id
+        self._cancelled = False
+        self._checked_at = 0.0
+
+    def cancelled(self, force: bool = False) -> bool:
+        if self._cancelled: return True
+        now = time.time()
+        if force or now - self._checked_at >= CANCEL_POLL_SECONDS:
+            self._checked_at = now
+            self._cancelled = database.is_cancelled(self.task_id)
+        return self._cancelled
+
+_current_cancel = contextvars.ContextVar("report_cancel", default=None)
+
+@contextmanager
+def cancel_scope(task_id: str = None):
+    token = _current_cancel.set(CancelToken(task_id) if task_id else None)
+    try:
+        yield
+    finally:
+        _current_cancel.reset(token)
+
+def check_cancelled(force: bool = False):
+    cancel = _current_cancel.get()
+    if cancel and cancel.cancelled(force):
+        raise ReportCancelled(f"Report {cancel.task_id} was cancelled.")
+
+# In-flight HTTP requests of a report run here so the report can stop waiting as soon as it is
+# cancelled. An abandoned request finishes (or times out) in the background and its connection
+# goes back to the shared pool; other reports' requests are never touched.
+_request_pool = ThreadPoolExecutor(max_workers=int(os.environ.get("HTTP_REQUEST_THREADS", 64)), thread_name_prefix="http")
+
+def _cancellable(fn, *args, **kwargs):
+    """Calls fn(*args, **kwargs), raising ReportCancelled if the report is cancelled while it runs."""
+    cancel = _current_cancel.get()
+    if not cancel: return fn(*args, **kwargs)
+    future = _request_pool.submit(fn, *args, **kwargs)
+    while True:
+        try:
+            return future.result(timeout=CANCEL_POLL_SECONDS)
+        except FutureTimeout:
+            if cancel.cancelled(): raise ReportCancelled(f"Report {cancel.task_id} was cancelled.")
+
+# --- LLM TRACING ---
+_trace_stage = contextvars.ContextVar("llm_trace_stage", default=None)
+
+@contextmanager
+def trace_stage(stage: str):
+    """Tags every LLM call made inside the block with the pipeline stage for llm_traces."""
+    token = _trace_stage.set(stage)
+    try:
+        yield
+    finally:
+        _trace_stage.reset(token)
+
+def record_llm_call(model: str, attempt: int, latency: float, outcome: str, usage: dict = None):
+    """Feeds one completion attempt to the Prometheus metrics and the persistent llm_traces log."""
+    metrics.observe_llm(model, latency, outcome, usage)
+    now, usage = time.time(), usage or {}
+    tracing.child_span("llm.completion", now - latency, now, **{
+        "llm.model": model, "llm.attempt": attempt, "llm.outcome": outcome,
+        "llm.prompt_tokens": usage.get("prompt_tokens"), "llm.completion_tokens": usage.get("completion_tokens")
+    })
+    cancel = _current_cancel.get()
+    database.record_llm_trace(model, _trace_stage.get(), latency, outcome, attempt, usage, report_id=cancel.task_id if cancel else None)
+
+def record_scrape(url: str, start: float, outcome: str):
+    metrics.observe_scrape(url, time.time() - start, outcome)
+    tracing.child_span("scrape", start, time.time(), **{"http.url": url, "scrape.outcome": outcome})
+
+# --- PROGRESS & ETA ---
+PIPELINE_STAGES = ["search", "summary", "chart", "outline", "section", "finalize"]
+# Fallback seconds per stage until a tier/model has recorded history.
+DEFAULT_STAGE_SECONDS = {"search": 20, "summary": 25, "chart": 20, "outline": 10, "section": 45, "finalize": 2}
+
+class ReportProgress:
+    """Structured progress for one report: stage, section, percent and an ETA from historical stage timings."""
+
+    def __init__(self, task=None, tier: str = "long", expected_sections: int = 10, model: str = SMART_MODEL, task_id: str = None,
+                 section_parallelism: int = 1):
+        self.task = task
+        self.task_id = task_id  # set when reporting on behalf of another task (chord subtasks)
+        self.tier = tier
+        self.model = model
+        history = {row["stage"]: row["seconds"] for row in database.get_stage_estimates(tier, model)}
+        self.estimates = {stage: history.get(stage, seconds) for stage, seconds in DEFAULT_STAGE_SECONDS.items()}
+        self.sections_total = expected_sections  # replaced by the real outline length once known
+        self.sections_done = 0
+        # Sections written at once: 1 sequentially, None for all of them (the distributed chord).
+        self.section_parallelism = section_parallelism
+
+    def snapshot(self, stage: str, message: str) -> dict:
+        width = self.section_parallelism or self.sections_total
+        sections_cost = self.estimates["section"] * math.ceil(self.sections_total / max(1, width))  # wall time
+        total = sum(v for k, v in self.estimates.items() if k != "section") + sections_cost
+        position = PIPELINE_STAGES.index(stage)
+        done = sum(self.estimates[s] for s in PIPELINE_STAGES[:position] if s != "section")
+        if stage == "section": done += sections_cost * self.sections_done / max(1, self.sections_total)
+        elif position > PIPELINE_STAGES.index("section"): done += sections_cost
+        return {
+            "message": message,
+            "stage": stage,
+            "section": self.sections_done + 1 if stage == "section" else None,
+            "sections_total": self.sections_total,
+            "percent": min(99, int(100 * done / total)) if total else 0,
+            "eta_seconds": int(max(0, total - done))
+        }
+
+    def update(self, stage: str, message: str, sections_done: int = None):
+        # Every stage and section boundary reports progress, so it doubles as the cancellation point.
+        check_cancelled(force=True)
+        if sections_done is not None: self.sections_done = sections_done
+        print(message)
+        if self.task: self.task.update_state(task_id=self.task_id, state='PROGRESS', meta=self.snapshot(stage, message))
+
+    def timed(self, stage: str, produce):
+        """Wraps a stage so its duration feeds the ETA history (checkpoint hits are never timed)."""
+        def _run():
+            start = time.time()
+            with trace_stage(stage), tracing.span(f"stage.{stage}", tier=self.tier):
+                value = produce()
+            duration = time.time() - start
+            database.record_stage_timing(stage, self.tier, self.model, duration)
+            metrics.observe_stage(stage, self.tier, duration)
+            return value
+        return _run
+
 # --- HELPER FUNCTIONS ---
 def clean_ai_output(text: str) -> str:
     if not text: return ""
@@ -48,228 +265,471 @@ def clean_section_output(text: str, section_title: str) -> str:
     return text.strip()
 
 # --- LLM CALLER ---
+def llm_request(model: str, system_prompt: str, user_prompt: str, temp: float) -> dict:
+    """Headers and JSON body for one OpenRouter chat completion (shared by the sync and async callers)."""
+    return {
+        "headers": {
+            "Authorization": f"Bearer {os.environ.get('OPENROUTER_API_KEY')}", 
+            "Content-Type": "application/json",
+            "HTTP-Referer": "http://localhost:5000",
+            "X-Title": "ScholarForge"
+        },
+        "json": {
+            "model": model,
+            "messages": [
+                {"role": "system", "content": system_prompt}, 
+                {"role": "user", "content": user_prompt}
+            ],
+            "temperature": temp,
+            "max_tokens": 4000
+        }
+    }
+
 def call_llm(target_model: str, system_prompt: str, user_prompt: str, temp: float = 0.4, attempt: int = 1) -> str:
     current_model = target_model
     
     if attempt == 2:
         current_model = BACKUP_MODEL
+        metrics.observe_retry(current_model)
         print(f"   >>> Grok failed. Switching to BACKUP: {current_model}")
     elif attempt > 2:
         return f"Error: Both AI models failed. Please try again later."
 
+    start = time.time()
     try:
-        api_key = os.environ.get("OPENROUTER_API_KEY")
-        timeout = 60.0 
+        budget = current_budget()
+        timeout = budget.timeout(LLM_TIMEOUT) if budget else LLM_TIMEOUT
         
         system_prompt += " Do NOT use code blocks. Output raw Markdown only."
 
-        with httpx.Client(timeout=timeout) as client:
-            response = client.post(
-                url="https://openrouter.ai/api/v1/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {api_key}", 
-                    "Content-Type": "application/json",
-                    "HTTP-Referer": "http://localhost:5000",
-                    "X-Title": "ScholarForge"
-                },
-                json={
-                    "model": current_model,
-                    "messages": [
-                        {"role": "system", "content": system_prompt}, 
-                        {"role": "user", "content": user_prompt}
-                    ],
-                    "temperature": temp,
-                    "max_tokens": 4000
-                }
-            )
+        response = _cancellable(
+            get_http_client("llm").post, url=OPENROUTER_URL, timeout=timeout, **llm_request(current_model, system_prompt, user_prompt, temp)
+        )
+        
+        if response.status_code != 200:
+            record_llm_call(current_model, attempt, time.time() - start, f"http_{response.status_code}")
+            print(f"   [!] AI Error ({current_model}): {response.status_code}")
+            return call_llm(target_model, system_prompt, user_prompt, temp, attempt + 1)
             
-            if response.status_code != 200:
-                print(f"   [!] AI Error ({current_model}): {response.status_code}")
-                return call_llm(target_model, system_prompt, user_prompt, temp, attempt + 1)
-                
-            return clean_ai_output(response.json()['choices'][0]['message']['content'])
+        result = response.json()
+        record_llm_call(current_model, attempt, time.time() - start, "ok", result.get('usage'))
+        return clean_ai_output(result['choices'][0]['message']['content'])
             
+    except ReportCancelled:
+        raise
     except Exception as e:
+        record_llm_call(current_model, attempt, time.time() - start, "error")
+        check_cancelled(force=True)
         print(f"   [!] Exception ({current_model}): {e}")
         return call_llm(target_model, system_prompt, user_prompt, temp, attempt + 1)
 
-# --- TASKS ---
+# --- PROMPTS & PARSERS ---
+# Each *_prompt returns (system_prompt, user_prompt, temp) for call_llm / call_llm_async.
 
-def generate_summary(search_content: str, topic: str) -> str:
-    return call_llm(
-        SMART_MODEL,
+def summary_prompt(search_content: str, topic: str) -> tuple:
+    return (
         "You are a Senior Research Analyst.",
-        f"Topic: {topic}\n\nRaw Data:\n{search_content[:15000]}\n\nTask: Summarize key facts, numbers, and trends."
+        f"Topic: {topic}\n\nRaw Data:\n{search_content[:15000]}\n\nTask: Summarize key facts, numbers, and trends.",
+        0.4
     )
 
-def generate_outline(topic: str, summary: str, format_type: str, target_pages: int) -> list:
+def outline_prompt(topic: str, summary: str, format_type: str, target_pages: int) -> tuple:
     format_data = get_template_instructions(format_type, target_pages)
     prompt = (
         f"Topic: {topic}\nTarget: {format_data['target_sections']} sections.\n"
         f"Logic: {format_data['template_text']}\nContext: {summary[:2000]}\n"
         "Output: A JSON list of strings ONLY. Example: [\"1. Intro\", \"2. Body\"]"
     )
-    content = call_llm(SMART_MODEL, "Return JSON only.", prompt, temp=0.2)
-    
+    return "Return JSON only.", prompt, 0.2
+
+def parse_outline(content: str) -> list:
     match = re.search(r'\[.*\]', content.replace('\n', ' '), re.DOTALL)
     if match: return json.loads(match.group(0))
     return ["Introduction", "Analysis", "Conclusion"]
 
-def generate_chart_from_data(summary: str, topic: str) -> str:
-    try:
-        chart_dir = "/app/static/charts"
-        if not os.path.exists(chart_dir): os.makedirs(chart_dir, exist_ok=True)
-        
-        clean_name = re.sub(r'\W+', '', topic)[:15] 
-        filename = f"chart_{clean_name}_{os.urandom(4).hex()}.png"
-        filepath = os.path.join(chart_dir, filename)
-
-        prompt = (
-            f"Topic: {topic}\nContext: {summary[:3000]}\n"
-            "Extract key trends/stats. ESTIMATE values if needed.\n"
-            "Return JSON: {\"title\": \"...\", \"x_label\": \"...\", \"y_label\": \"...\", \"data\": [{\"label\": \"A\", \"value\": 10}]}"
-        )
-        
-        content = call_llm(SMART_MODEL, "Return JSON only.", prompt, temp=0.1)
-        match = re.search(r'\{.*\}', content.replace('\n', ' '), re.DOTALL)
-        if not match: return None
-        
-        chart_data = json.loads(match.group(0))
-        if not chart_data or 'data' not in chart_data: return None
+def chart_prompt(summary: str, topic: str) -> tuple:
+    prompt = (
+        f"Topic: {topic}\nContext: {summary[:3000]}\n"
+        "Extract key trends/stats. ESTIMATE values if needed.\n"
+        "Return JSON: {\"title\": \"...\", \"x_label\": \"...\", \"y_label\": \"...\", \"data\": [{\"label\": \"A\", \"value\": 10}]}"
+    )
+    return "Return JSON only.", prompt, 0.1
+
+def parse_chart_data(content: str) -> dict:
+    match = re.search(r'\{.*\}', content.replace('\n', ' '), re.DOTALL)
+    if not match: return None
+    chart_data = json.loads(match.group(0))
+    if not chart_data or 'data' not in chart_data: return None
+    return chart_data
+
+def render_chart(chart_data: dict, topic: str) -> str:
+    """CPU-bound: draws the bar chart PNG and returns its path."""
+    chart_dir = "/app/static/charts"
+    if not os.path.exists(chart_dir): os.makedirs(chart_dir, exist_ok=True)
+    
+    clean_name = re.sub(r'\W+', '', topic)[:15] 
+    filename = f"chart_{clean_name}_{os.urandom(4).hex()}.png"
+    filepath = os.path.join(chart_dir, filename)
 
-        df = pd.DataFrame(chart_data['data'])
-        
-        # FIX: Use Object-Oriented Matplotlib interface for Thread Safety in Celery
-        fig, ax = plt.subplots(figsize=(10, 6))
-        plt.style.use('ggplot')
-        
-        ax.bar(df['label'], df['value'], color='#4f46e5', alpha=0.8)
-        ax.set_title(chart_data.get('title', 'Analysis'), fontsize=14, pad=20)
-        ax.set_xlabel(chart_data.get('x_label', ''), fontsize=12)
-        ax.set_ylabel(chart_data.get('y_label', ''), fontsize=12)
-        
-        # Rotate x labels nicely
-        plt.setp(ax.get_xticklabels(), rotation=45, ha='right')
-        
-        fig.tight_layout()
-        fig.savefig(filepath, dpi=100)
-        plt.close(fig) # Explicitly close figure to free memory
-        
-        return filepath
-    except Exception as e:
-        print(f"Chart Gen Error: {e}")
-        return None
+    df = pd.DataFrame(chart_data['data'])
+    
+    # FIX: Use Object-Oriented Matplotlib interface for Thread Safety in Celery
+    fig, ax = plt.subplots(figsize=(10, 6))
+    plt.style.use('ggplot')
+    
+    ax.bar(df['label'], df['value'], color='#4f46e5', alpha=0.8)
+    ax.set_title(chart_data.get('title', 'Analysis'), fontsize=14, pad=20)
+    ax.set_xlabel(chart_data.get('x_label', ''), fontsize=12)
+    ax.set_ylabel(chart_data.get('y_label', ''), fontsize=12)
+    
+    # Rotate x labels nicely
+    plt.setp(ax.get_xticklabels(), rotation=45, ha='right')
+    
+    fig.tight_layout()
+    fig.savefig(filepath, dpi=100)
+    plt.close(fig) # Explicitly close figure to free memory
+    
+    return filepath
 
-def critique_and_refine(section_text: str, topic: str) -> str:
+def critique_prompt(section_text: str, topic: str) -> tuple:
     critic_prompt = (
         f"Topic: {topic}\nDraft:\n{section_text[:2000]}\n"
         "Identify ONE specific missing statistic. Return ONLY the search query. If good, return 'Pass'."
     )
-    critique = call_llm(SMART_MODEL, "You are a harsh Editor.", critic_prompt, temp=0.1)
-    
-    if "Pass" in critique or "Error" in critique or len(critique) > 80: return section_text 
-    
-    new_data = get_search_results(critique, max_results=2)
-    if "Error" in new_data or "No results" in new_data: return section_text
+    return "You are a harsh Editor.", critic_prompt, 0.1
+
+def critique_passes(critique: str) -> bool:
+    return "Pass" in critique or "Error" in critique or len(critique) > 80
 
-    refine_prompt = (
+def refine_prompt(section_text: str, new_data: str) -> tuple:
+    prompt = (
         f"Draft:\n{section_text}\n\nNew Verified Data:\n{new_data[:1500]}\n"
         "Integrate this new data naturally. Maintain Markdown."
     )
-    return call_llm(SMART_MODEL, "You are a Senior Editor.", refine_prompt, temp=0.3)
+    return "You are a Senior Editor.", prompt, 0.3
 
-def write_section(section_title: str, topic: str, summary: str, full_report_context: str, word_limit: int) -> str:
+def section_prompt(section_title: str, topic: str, summary: str, word_limit: int) -> tuple:
     base_prompt = f"Write a detailed report section '{section_title}' for a report on '{topic}'. Use research: {summary}. Length: {word_limit} words."
     
     keywords_for_table = ['comparison', 'market', 'financial', 'analysis', 'growth', 'impact', 'forecast', 'roi', 'cost']
     if any(k in section_title.lower() for k in keywords_for_table):
         base_prompt += "\n\nIMPORTANT: You MUST include a Markdown table comparing key metrics in this section."
+    return "You are a Report Writer. Use Markdown.", base_prompt, 0.5
 
-    content = call_llm(SMART_MODEL, "You are a Report Writer. Use Markdown.", base_prompt, temp=0.5)
+# --- TASKS ---
+
+def generate_summary(search_content: str, topic: str) -> str:
+    return call_llm(SMART_MODEL, *summary_prompt(search_content, topic))
+
+def generate_outline(topic: str, summary: str, format_type: str, target_pages: int) -> list:
+    content = call_llm(SMART_MODEL, *outline_prompt(topic, summary, format_type, target_pages))
+    return parse_outline(content)
+
+def generate_chart_from_data(summary: str, topic: str) -> str:
+    try:
+        content = call_llm(SMART_MODEL, *chart_prompt(summary, topic))
+        chart_data = parse_chart_data(content)
+        if not chart_data: return None
+        return render_chart(chart_data, topic)
+    except ReportCancelled:
+        raise
+    except Exception as e:
+        print(f"Chart Gen Error: {e}")
+        return None
+
+def critique_and_refine(section_text: str, topic: str) -> str:
+    critique = call_llm(SMART_MODEL, *critique_prompt(section_text, topic))
+    
+    if critique_passes(critique): return section_text 
+    
+    new_data = get_search_results(critique, max_results=2)
+    if "Error" in new_data or "No results" in new_data: return section_text
+
+    return call_llm(SMART_MODEL, *refine_prompt(section_text, new_data))
+
+def write_section(section_title: str, topic: str, summary: str, full_report_context: str, word_limit: int, allow_critique: bool = True) -> str:
+    content = call_llm(SMART_MODEL, *section_prompt(section_title, topic, summary, word_limit))
     
-    if word_limit > 400 and "Error" not in content:
+    if word_limit > 400 and "Error" not in content and allow_critique:
         content = critique_and_refine(content, topic)
         
     return clean_section_output(content, section_title)
 
 # --- SCRAPING ---
-def _get_article_text(url: str) -> str:
-    try:
-        headers = {'User-Agent': 'Mozilla/5.0'}
-        with httpx.Client(timeout=15.0, follow_redirects=True) as client:
-            response = client.get(url, headers=headers)
-        if response.status_code != 200: return ""
+SCRAPE_HEADERS = {'User-Agent': 'Mozilla/5.0'}
+SEARCH_PARAMS = {"location": "US", "hl": "en", "gl": "us", "num": 5, "engine": "google"}
+
+def extract_article_text(url: str, content_type: str, body: bytes, text: str) -> str:
+    """CPU-bound: turns a fetched page or PDF into plain text."""
+    # Check for PDF
+    if "application/pdf" in content_type or url.endswith(".pdf"):
+        try:
+            # fitz.open with stream requires "filetype" hint
+            with fitz.open(stream=body, filetype="pdf") as doc:
+                text = ""
+                for i, page in enumerate(doc):
+                    if i > 5: break 
+                    text += page.get_text()
+            return f"--- PDF SOURCE ---\n{text[:4000]}\n---"
+        except: return ""
         
-        # Check for PDF
-        if "application/pdf" in response.headers.get("Content-Type", "") or url.endswith(".pdf"):
-            try:
-                # fitz.open with stream requires "filetype" hint
-                with fitz.open(stream=response.content, filetype="pdf") as doc:
-                    text = ""
-                    for i, page in enumerate(doc):
-                        if i > 5: break 
-                        text += page.get_text()
-                return f"--- PDF SOURCE ---\n{text[:4000]}\n---"
-            except: return ""
-            
-        soup = BeautifulSoup(response.text, 'lxml')
-        for tag in soup(['script', 'style', 'nav', 'footer']): tag.decompose()
-        return soup.get_text(separator='\n', strip=True)[:4000]
-    except: return ""
+    soup = BeautifulSoup(text, 'lxml')
+    for tag in soup(['script', 'style', 'nav', 'footer']): tag.decompose()
+    return soup.get_text(separator='\n', strip=True)[:4000]
+
+def format_source(result: dict, full_text: str = "") -> str:
+    full = f"\n[Full]: {full_text[:1500]}" if full_text else ""
+    return f"Source: {result.get('title', '')}\nURL: {result.get('link', '')}\nSummary: {result.get('snippet', '')}{full}"
+
+def plan_scraping(budget: ReportBudget, max_results: int, parallel: bool = False) -> tuple[int, float]:
+    """Returns how many top results to scrape and the per-scrape timeout, decided before the first scrape.
+
+    Scraping gets SCRAPE_BUDGET_SHARE of the report budget; sequential scrapes split it between them,
+    parallel ones each get all of it. Small result sets (critique searches) are never scraped.
+    """
+    if max_results <= 3: return 0, 0.0
+    if not budget: return MAX_RESULTS_TO_SCRAPE, SCRAPE_TIMEOUT
+    allowance = min(budget.total * SCRAPE_BUDGET_SHARE, budget.remaining())
+    count = MAX_RESULTS_TO_SCRAPE if parallel else int(allowance // MIN_SCRAPE_TIMEOUT)
+    count = min(MAX_RESULTS_TO_SCRAPE, count) if allowance >= MIN_SCRAPE_TIMEOUT else 0
+    timeout = min(SCRAPE_TIMEOUT, allowance if parallel else allowance / max(1, count))
+    if count < MAX_RESULTS_TO_SCRAPE or timeout < SCRAPE_TIMEOUT:
+        budget.degrade("reduced_scraping")
+    return count, timeout
+
+def _get_article_text(url: str, timeout: float = SCRAPE_TIMEOUT) -> str:
+    start = time.time()
+    try:
+        response = _cancellable(get_http_client("scrape").get, url, headers=SCRAPE_HEADERS, timeout=timeout)
+        if response.status_code != 200:
+            record_scrape(url, start, f"http_{response.status_code}")
+            return ""
+        text = extract_article_text(url, response.headers.get("Content-Type", ""), response.content, response.text)
+        record_scrape(url, start, "ok")
+        return text
+    except:
+        record_scrape(url, start, "error")
+        return ""
 
 def get_search_results(query: str, max_results: int = SEARCH_RESULTS_COUNT) -> str:
     try:
         api_key = os.environ.get("SERPAPI_KEY") 
         if not api_key: return "Error: SERPAPI_KEY not set."
-        client = serpapi.Client(api_key=api_key)
-        results = client.search({"q": query, "location": "US", "hl": "en", "gl": "us", "num": 5, "engine": "google"})
+        client = get_serpapi_client(api_key)
+        start = time.time()
+        results = client.search({"q": query, **SEARCH_PARAMS})
+        tracing.child_span("search.serpapi", start, time.time(), **{"search.query": query})
+        scrape_count, scrape_timeout = plan_scraping(current_budget(), max_results)
         snippets = []
         if "organic_results" in results:
             for i, result in enumerate(results["organic_results"]):
                 url = result.get("link", "")
-                title = result.get('title', '')
-                snippet = result.get("snippet", "")
-                full = ""
-                if url and max_results > 3 and i < MAX_RESULTS_TO_SCRAPE: 
-                    raw = _get_article_text(url)
-                    if raw: full = f"\n[Full]: {raw[:1500]}"
-                snippets.append(f"Source: {title}\nURL: {url}\nSummary: {snippet}{full}")
+                raw = ""
+                if url and i < scrape_count:
+                    check_cancelled()
+                    raw = _get_article_text(url, scrape_timeout)
+                snippets.append(format_source(result, raw))
+        check_cancelled(force=True)
         return "\n\n".join(snippets) if snippets else "No results."
+    except ReportCancelled: raise
     except Exception as e: return f"Search Error: {e}"
 
 # --- MAIN ORCHESTRATOR ---
-def run_ai_engine_with_return(query: str, user_format: str, page_count: int = 15, task=None) -> tuple[str, str, str]: 
-    def _update_status(message: str):
-        print(message) 
-        if task: task.update_state(state='PROGRESS', meta={'message': message})
-
-    if not query: return "No query.", "", None
-
-    _update_status("Step 1/6: Global Search (Deep Reading)...")
-    search_content = get_search_results(query)
+def plan_section(budget: ReportBudget, sections_left: int, word_limit: int) -> tuple[int, bool]:
+    """Returns the word limit and critique allowance the remaining budget can afford for the next section."""
+    per_section = budget.remaining() / max(1, sections_left)
+    allow_critique = per_section >= CRITIQUE_MIN_SECONDS
+    if not allow_critique and word_limit > 400:
+        budget.degrade("skipped_critique")
+    if per_section < SECTION_SECONDS:
+        shortened = max(MIN_SECTION_WORDS, int(word_limit * per_section / SECTION_SECONDS))
+        if shortened < word_limit:
+            budget.degrade("shortened_sections")
+            word_limit = shortened
+    return word_limit, allow_critique
+
+def checkpointer(task_id: str = None):
+    """Returns checkpointed(stage, produce): stage outputs are persisted under the task ID and reused on resume.
+
+    Only a redelivery of the same task ID can resume from them. A new request, even for the same
+    query, gets a new task ID, so partial work of a cancelled or failed report cannot be reused
+    while checkpoints are keyed this way; clear_report_state drops them when the task ends.
+    """
+    done = database.get_checkpoints(task_id) if task_id else {}
+    if done: print(f"   >>> Resuming {task_id} from checkpoints: {', '.join(sorted(done))}")
+
+    def checkpointed(stage: str, produce):
+        if stage in done: return done[stage]
+        value = produce()
+        if task_id: database.save_checkpoint(task_id, stage, value)
+        return value
+    return checkpointed
+
+def run_research_stages(query: str, user_format: str, page_count: int, checkpointed, progress: ReportProgress) -> dict:
+    """Steps 1-4: search, summary, chart and outline. Must run inside report_budget()."""
+    budget = current_budget()
+
+    progress.update("search", "Step 1/6: Global Search (Deep Reading)...")
+    search_content = checkpointed("search", progress.timed("search", lambda: get_search_results(query)))
     
-    _update_status("Step 2/6: Synthesizing...")
-    summary = generate_summary(search_content, query)
+    progress.update("summary", "Step 2/6: Synthesizing...")
+    summary = checkpointed("summary", progress.timed("summary", lambda: generate_summary(search_content, query)))
     
-    _update_status("Step 3/6: Visualizing Data...")
-    chart_path = generate_chart_from_data(summary, query)
+    progress.update("chart", "Step 3/6: Visualizing Data...")
+    def _chart():
+        if budget.remaining() >= CHART_MIN_SECONDS:
+            return progress.timed("chart", lambda: generate_chart_from_data(summary, query))()
+        budget.degrade("skipped_chart")
+        return None
+    chart_path = checkpointed("chart", _chart)
     
-    _update_status("Step 4/6: Planning Structure...")
-    outline = generate_outline(query, summary, user_format, page_count)
+    progress.update("outline", "Step 4/6: Planning Structure...")
+    outline = checkpointed("outline", progress.timed("outline", lambda: generate_outline(query, summary, user_format, page_count)))
+    progress.sections_total = len(outline)
 
     total_words = page_count * WORDS_PER_PAGE 
-    words_per_section = max(300, int(total_words / max(1, len(outline))))
-    
+    return {
+        "search_content": search_content,
+        "summary": summary,
+        "chart_path": chart_path,
+        "outline": outline,
+        "words_per_section": max(300, int(total_words / max(1, len(outline))))
+    }
+
+def write_report_section(index: int, section: str, query: str, summary: str, report_so_far: str, words_per_section: int, sections_left: int, checkpointed, progress: ReportProgress = None) -> str:
+    """Step 5 for a single section. Must run inside report_budget()."""
+    def _section():
+        word_limit, allow_critique = plan_section(current_budget(), sections_left, words_per_section)
+        return write_section(section, query, summary, report_so_far, word_limit, allow_critique)
+    return checkpointed(f"section:{index}", progress.timed("section", _section) if progress else _section)
+
+def assemble_report(query: str, outline: list, sections: list) -> str:
+    """Step 6: stitch the written sections under the report title."""
     full_report = f"# {query.upper()}\n\n"
-    for i, section in enumerate(outline):
-        _update_status(f"Step 5/6: Researching & Writing {i+1}/{len(outline)}...")
-        section_content = write_section(section, query, summary, full_report, words_per_section)
+    for section, section_content in zip(outline, sections):
         full_report += f"\n\n## {section}\n{section_content}\n"
-    
-    _update_status("Step 6/6: Finalizing...")
-    full_report = clean_ai_output(full_report)
-    
-    return search_content, full_report, chart_path
+    return clean_ai_output(full_report)
+
+# --- SINGLE-SECTION REGENERATION ---
+def _section_pattern(section: str, outline: list = None):
+    """A section runs to the heading of the next outline entry (or the end of the report), so '## '
+    subheadings the LLM wrote inside it stay part of it. Without an outline, any '## ' ends it."""
+    following = outline[outline.index(section) + 1:] if outline and section in outline else None
+    if following:
+        end = rf"^## {re.escape(following[0])}[ \t]*$"
+    else:
+        end = r"\Z" if outline and section in outline else r"^## |\Z"
+    return re.compile(rf"^## {re.escape(section)}[ \t]*\n(.*?)(?={end})", re.MULTILINE | re.DOTALL)
+
+def find_section(report_content: str, section: str, outline: list = None) -> str:
+    match = _section_pattern(section, outline).search(report_content or "")
+    if not match: raise ValueError(f"Section '{section}' not found in report.")
+    return match.group(1).strip()
+
+def replace_section(report_content: str, section: str, new_content: str, outline: list = None) -> str:
+    """Swaps the body under '## {section}' for new_content, leaving every other section untouched."""
+    def _splice(match):
+        tail = "\n\n\n" if match.end() < len(report_content) else ""
+        return match.group(0)[:match.start(1) - match.start()] + new_content.strip() + tail
+    return _section_pattern(section, outline).sub(_splice, report_content, count=1)
+
+def regenerate_section(topic: str, summary: str, report_content: str, section: str, time_budget: int = SECTION_REGEN_SECONDS,
+                       outline: list = None) -> tuple[str, list]:
+    """Rewrites one section from the report's persisted summary: one write_section call instead of the full pipeline."""
+    current = find_section(report_content, section, outline)
+    with report_budget(time_budget) as budget, trace_stage("regenerate_section"):
+        word_limit, allow_critique = plan_section(budget, 1, max(300, len(current.split())))
+        content = write_section(section, topic, summary, "", word_limit, allow_critique)
+    if not content or content.startswith("Error"):
+        raise RuntimeError(content or "Section generation returned no content.")
+    return replace_section(report_content, section, content, outline), budget.degradations
+
+def run_ai_engine_with_return(query: str, user_format: str, page_count: int = 15, task=None, time_budget: int = None) -> tuple[str, str, str, list]: 
+    if not query: return "No query.", "", None, []
+
+    # Stage outputs are checkpointed under the task ID, so a redelivered task resumes where it died.
+    # Checkpoints are cleared once the task ends (done, cancelled or failed); see checkpointer().
+    task_id = task.request.id if task else None
+    checkpointed = checkpointer(task_id)
+
+    format_data = get_template_instructions(user_format, page_count)
+    progress = ReportProgress(task, format_data["tier"], format_data["target_sections"])
+    with report_budget(time_budget or format_data["time_budget"]) as budget, cancel_scope(task_id):
+        research = run_research_stages(query, user_format, page_count, checkpointed, progress)
+        outline = research["outline"]
+
+        sections = []
+        for i, section in enumerate(outline):
+            progress.update("section", f"Step 5/6: Researching & Writing {i+1}/{len(outline)}...", sections_done=i)
+            report_so_far = assemble_report(query, outline[:i], sections)
+            sections.append(write_report_section(
+                i, section, query, research["summary"], report_so_far,
+                research["words_per_section"], len(outline) - i, checkpointed, progress
+            ))
+        
+        progress.update("finalize", "Step 6/6: Finalizing...")
+        full_report = assemble_report(query, outline, sections)
+        
+        return research["search_content"], full_report, research["chart_path"], budget.degradations
+
+# --- WORKER WARM-UP ---
+def _warm_matplotlib():
+    from matplotlib import font_manager
+    plt.style.use('ggplot')
+    font_manager.findfont(plt.rcParams['font.family'][0])
+    fig, ax = plt.subplots(figsize=(2, 1))
+    ax.bar(["a"], [1])
+    fig.savefig(io.BytesIO(), format="png")
+    plt.close(fig)
+
+def _warm_reportlab():
+    styles = getSampleStyleSheet()
+    SimpleDocTemplate(io.BytesIO(), pagesize=A4).build([Paragraph("<b>warm-up</b>", styles['Normal'])])
+
+def _warm_pymupdf():
+    with fitz.open() as doc:
+        doc.new_page()
+
+WARM_UP_NETWORK_TIMEOUT = 3.0
+
+def _warm_openrouter():
+    get_http_client("llm").head(OPENROUTER_URL.rsplit("/api/", 1)[0], timeout=WARM_UP_NETWORK_TIMEOUT)
+
+def _warm_serpapi():
+    api_key = os.environ.get("SERPAPI_KEY")
+    if not api_key: return
+    session = getattr(get_serpapi_client(api_key), "session", None)
+    if session: session.head(SERPAPI_URL, timeout=WARM_UP_NETWORK_TIMEOUT)
+
+def _run_warm_up(steps: list) -> dict:
+    timings = {}
+    for name, step in steps:
+        start = time.time()
+        try:
+            step()
+        except Exception as e:
+            print(f"   [warm-up] {name} failed: {e}")
+        timings[name] = round(time.time() - start, 3)
+    return timings
+
+def warm_up() -> dict:
+    """Local, CPU-only initialization: safe inside worker_process_init, which Celery aborts
+    if the child is not up within worker_proc_alive_timeout. Returns seconds spent per step."""
+    return _run_warm_up([
+        ("matplotlib", _warm_matplotlib),
+        ("reportlab", _warm_reportlab),
+        ("pymupdf", _warm_pymupdf),
+        ("db pool", database.release_parent_connections),
+    ])
+
+def warm_up_network():
+    """Opens the OpenRouter/SerpAPI TLS connections and a DB connection on a background thread,
+    so slow DNS or handshakes never delay the worker reporting ready."""
+    def _run():
+        timings = _run_warm_up([("openrouter", _warm_openrouter), ("serpapi", _warm_serpapi), ("database", database.warm_up)])
+        details = ", ".join(f"{name}={seconds:.2f}s" for name, seconds in timings.items())
+        print(f"[warm-up] Worker process {os.getpid()} connections ready ({details})")
+    threading.Thread(target=_run, daemon=True, name="warm-up").start()
 
 # --- CONVERTERS ---
 
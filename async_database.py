@@ -0,0 +1,131 @@
+import os
+import asyncio
+from datetime import datetime, timezone
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+import database
+from database import ChatMessage, Hook, SQLALCHEMY_DATABASE_URL, MESSAGE_PAGE_SIZE, POOL_OPTIONS
+import metrics
+import tracing
+
+# Async twin of the database.py functions that async FastAPI routes call, so a slow query
+# no longer blocks the event loop for every other request. Same tables, same queries;
+# only the driver differs (aiosqlite / asyncpg).
+
+# --- SETUP ---
+def _async_url(url: str) -> str:
+    if url.startswith("sqlite://"): return url.replace("sqlite://", "sqlite+aiosqlite://", 1)
+    if url.startswith("postgresql://"): return url.replace("postgresql://", "postgresql+asyncpg://", 1)
+    return url
+
+# SQLite pragmas (WAL, foreign_keys) come from database.py's connect listener, which covers every Engine.
+async_engine = create_async_engine(
+    _async_url(SQLALCHEMY_DATABASE_URL), **({} if SQLALCHEMY_DATABASE_URL.startswith("sqlite") else POOL_OPTIONS)
+)
+metrics.instrument_engine(async_engine.sync_engine)
+tracing.instrument_engine(async_engine.sync_engine)
+
+AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
+
+async def dispose():
+    await async_engine.dispose()
+
+# --- SESSIONS ---
+async def get_session_messages(session_id: int, limit: int = MESSAGE_PAGE_SIZE, before_id: int = None) -> tuple[list, bool]:
+    if any(turn[0] == session_id for turn in _pending_turns): await flush_chat_writes()  # read your own writes
+    cached = database.cached_messages(session_id, limit, before_id)
+    if cached is not None: return cached
+    generation = database._chat_history.generation
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(database.session_messages_statement(session_id, database.history_fetch_size(limit, before_id), before_id))
+        return database.history_page(session_id, result.all(), limit, before_id, generation)
+
+async def get_all_session_messages(session_id: int) -> list:
+    """The whole session, oldest first: the newest window (usually a cache hit), then older pages."""
+    messages, has_more = await get_session_messages(session_id, database.CHAT_CACHE_WINDOW)
+    while has_more:
+        older, has_more = await get_session_messages(session_id, database.CHAT_CACHE_WINDOW, messages[0].id)
+        messages = older + messages
+    return messages
+
+async def save_chat_message(session_id: int, role: str, content: str):
+    async with AsyncSessionLocal() as db:
+        await _save_messages(db, [ChatMessage(session_id=session_id, role=role, content=content)])
+
+async def _save_messages(db, messages: list):
+    db.add_all(messages)
+    await db.commit()  # expire_on_commit=False: ids and values stay readable
+    database.remember_messages(database.history_snapshot(messages))
+
+# --- CHAT WRITE-BEHIND ---
+# With CHAT_WRITE_BEHIND=true, /chat turns are queued and written by one commit per
+# CHAT_FLUSH_INTERVAL (or every CHAT_FLUSH_MAX turns) instead of one commit per turn, so a
+# burst of chats costs a handful of fsyncs. Queued turns are lost if the process is killed
+# (they are flushed on a normal shutdown), and only this process reads its own writes early.
+CHAT_WRITE_BEHIND = os.environ.get("CHAT_WRITE_BEHIND", "false").lower() == "true"
+CHAT_FLUSH_INTERVAL = float(os.environ.get("CHAT_FLUSH_INTERVAL", 0.2))  # seconds
+CHAT_FLUSH_MAX = int(os.environ.get("CHAT_FLUSH_MAX", 100))
+
+_pending_turns = []  # (session_id, user_message, assistant_message, created_at)
+_flush_lock = asyncio.Lock()
+_flush_task = None
+
+async def _write_turns(turns: list):
+    async with AsyncSessionLocal() as db:
+        await _save_messages(db, [row for turn in turns for row in database.chat_turn_rows(*turn)])
+
+async def save_chat_turn(session_id: int, user_message: str, assistant_message: str):
+    global _flush_task
+    turn = (session_id, user_message, assistant_message, datetime.now(timezone.utc))
+    if not CHAT_WRITE_BEHIND:
+        await _write_turns([turn])
+        return
+    _pending_turns.append(turn)
+    if len(_pending_turns) >= CHAT_FLUSH_MAX:
+        await flush_chat_writes()
+    elif _flush_task is None or _flush_task.done():
+        _flush_task = asyncio.ensure_future(_flush_after(CHAT_FLUSH_INTERVAL))
+
+async def _flush_after(delay: float):
+    # Loops until the queue is empty: turns queued while a flush is writing are picked up here,
+    # since save_chat_turn only schedules a new flusher once this one is done.
+    while _pending_turns:
+        await asyncio.sleep(delay)
+        await flush_chat_writes()
+
+async def flush_chat_writes():
+    """Writes every queued turn in one transaction. A failed batch (e.g. a session deleted while
+    its turn was queued) is retried turn by turn so one bad turn cannot take the rest with it."""
+    async with _flush_lock:
+        turns, _pending_turns[:] = list(_pending_turns), []
+        if not turns: return
+        batches = [turns]
+        while batches:
+            batch = batches.pop()
+            try:
+                await _write_turns(batch)
+            except Exception as e:
+                if len(batch) > 1:
+                    batches += [[turn] for turn in reversed(batch)]  # popped in original order
+                else:
+                    print(f"Chat Flush Error (session {batch[0][0]}, turn dropped): {e}")
+
+# --- REPORTS ---
+async def get_report_content(report_id: int, artifacts: bool = False):
+    async with AsyncSessionLocal() as db:
+        return (await db.execute(database.report_statement(report_id, artifacts))).scalars().first()
+
+async def save_hook(content: str):
+    async with AsyncSessionLocal() as db:
+        db.add(Hook(content=content))
+        await db.commit()
+
+# --- LLM TRACES ---
+async def record_llm_trace(*args, **kwargs):
+    async with AsyncSessionLocal() as db:
+        try:
+            db.add(database.llm_trace_row(*args, **kwargs))
+            await db.commit()
+        except Exception as e:
+            await db.rollback()
+            print(f"LLM Trace Error: {e}")
@@ -0,0 +1,291 @@
+import os
+import math
+import time
+import asyncio
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import httpx
+
+import AI_engine
+from AI_engine import (
+    SMART_MODEL, BACKUP_MODEL, OPENROUTER_URL, SERPAPI_URL, LLM_TIMEOUT, SCRAPE_TIMEOUT,
+    SEARCH_RESULTS_COUNT, CHART_MIN_SECONDS,
+    WORDS_PER_PAGE, CANCEL_POLL_SECONDS, SCRAPE_HEADERS, SEARCH_PARAMS,
+    ReportCancelled, current_budget, clean_ai_output, clean_section_output, llm_request
+)
+from report_formats import get_template_instructions
+import database
+import metrics
+import tracing
+
+# Async twin of AI_engine.run_ai_engine_with_return. Every report in a worker process shares
+# one event loop and one pooled HTTP client, so a process waiting on OpenRouter/SerpAPI can
+# carry dozens of reports at once. Run it with REPORT_PIPELINE=async under a thread pool:
+#   celery -A task.celery_app worker -P threads --concurrency=50
+
+# --- CONFIG ---
+ASYNC_SECTION_CONCURRENCY = int(os.environ.get("ASYNC_SECTION_CONCURRENCY", 4))  # sections in flight per report
+ASYNC_CPU_WORKERS = int(os.environ.get("ASYNC_CPU_WORKERS", os.cpu_count() or 2))
+ASYNC_MAX_CONNECTIONS = int(os.environ.get("ASYNC_MAX_CONNECTIONS", 200))
+
+# --- EVENT LOOP & POOLS ---
+_loop = None
+_loop_lock = threading.Lock()
+_cpu_pool = None
+_async_clients = {}  # only touched from the loop thread
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="report-event-loop", daemon=True).start()
+    return _loop
+
+def _get_cpu_pool():
+    global _cpu_pool
+    if _cpu_pool is None:
+        # Prefork children are daemonic and may not spawn processes; fall back to threads there.
+        if multiprocessing.current_process().daemon:
+            _cpu_pool = ThreadPoolExecutor(max_workers=ASYNC_CPU_WORKERS)
+        else:
+            _cpu_pool = ProcessPoolExecutor(max_workers=ASYNC_CPU_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _cpu_pool
+
+async def _offload(fn, *args):
+    """CPU-bound work (HTML/PDF parsing, chart rendering) goes to the process pool, off the loop."""
+    return await asyncio.get_running_loop().run_in_executor(_get_cpu_pool(), fn, *args)
+
+def get_async_client(purpose: str = "llm") -> httpx.AsyncClient:
+    client = _async_clients.get(purpose)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            follow_redirects=(purpose == "scrape"),
+            limits=httpx.Limits(max_connections=ASYNC_MAX_CONNECTIONS, max_keepalive_connections=20, keepalive_expiry=120.0)
+        )
+        _async_clients[purpose] = client
+    return client
+
+# --- LLM CALLER ---
+async def call_llm_async(target_model: str, system_prompt: str, user_prompt: str, temp: float = 0.4, attempt: int = 1) -> str:
+    current_model = target_model
+
+    if attempt == 2:
+        current_model = BACKUP_MODEL
+        metrics.observe_retry(current_model)
+        print(f"   >>> Grok failed. Switching to BACKUP: {current_model}")
+    elif attempt > 2:
+        return f"Error: Both AI models failed. Please try again later."
+
+    start = time.time()
+    try:
+        budget = current_budget()
+        timeout = budget.timeout(LLM_TIMEOUT) if budget else LLM_TIMEOUT
+
+        system_prompt += " Do NOT use code blocks. Output raw Markdown only."
+
+        response = await get_async_client("llm").post(
+            url=OPENROUTER_URL, timeout=timeout, **llm_request(current_model, system_prompt, user_prompt, temp)
+        )
+        if response.status_code != 200:
+            await asyncio.to_thread(AI_engine.record_llm_call, current_model, attempt, time.time() - start, f"http_{response.status_code}")
+            print(f"   [!] AI Error ({current_model}): {response.status_code}")
+            return await call_llm_async(target_model, system_prompt, user_prompt, temp, attempt + 1)
+
+        result = response.json()
+        await asyncio.to_thread(AI_engine.record_llm_call, current_model, attempt, time.time() - start, "ok", result.get('usage'))
+        return clean_ai_output(result['choices'][0]['message']['content'])
+
+    except Exception as e:
+        await asyncio.to_thread(AI_engine.record_llm_call, current_model, attempt, time.time() - start, "error")
+        print(f"   [!] Exception ({current_model}): {e}")
+        return await call_llm_async(target_model, system_prompt, user_prompt, temp, attempt + 1)
+
+# --- SEARCH & SCRAPING ---
+async def _get_article_text_async(url: str, timeout: float = SCRAPE_TIMEOUT) -> str:
+    start = time.time()
+    try:
+        response = await get_async_client("scrape").get(url, headers=SCRAPE_HEADERS, timeout=timeout)
+        if response.status_code != 200:
+            AI_engine.record_scrape(url, start, f"http_{response.status_code}")
+            return ""
+        text = await _offload(AI_engine.extract_article_text, url, response.headers.get("Content-Type", ""), response.content, response.text)
+        AI_engine.record_scrape(url, start, "ok")
+        return text
+    except Exception:
+        AI_engine.record_scrape(url, start, "error")
+        return ""
+
+async def get_search_results_async(query: str, max_results: int = SEARCH_RESULTS_COUNT) -> str:
+    try:
+        api_key = os.environ.get("SERPAPI_KEY")
+        if not api_key: return "Error: SERPAPI_KEY not set."
+        budget = current_budget()
+        start = time.time()
+        response = await get_async_client("search").get(
+            f"{SERPAPI_URL}/search.json", params={"q": query, "api_key": api_key, **SEARCH_PARAMS},
+            timeout=budget.timeout(LLM_TIMEOUT) if budget else LLM_TIMEOUT
+        )
+        tracing.child_span("search.serpapi", start, time.time(), **{"search.query": query})
+        response.raise_for_status()
+        organic = response.json().get("organic_results", [])
+
+        # Scrape the top results concurrently instead of one after another.
+        scrape_count, scrape_timeout = AI_engine.plan_scraping(budget, max_results, parallel=True)
+        to_scrape = [i for i, r in enumerate(organic) if r.get("link") and i < scrape_count]
+        texts = await asyncio.gather(*(_get_article_text_async(organic[i]["link"], scrape_timeout) for i in to_scrape))
+        full = dict(zip(to_scrape, texts))
+
+        snippets = [AI_engine.format_source(r, full.get(i, "")) for i, r in enumerate(organic)]
+        return "\n\n".join(snippets) if snippets else "No results."
+    except Exception as e: return f"Search Error: {e}"
+
+# --- TASKS ---
+async def generate_summary_async(search_content: str, topic: str) -> str:
+    return await call_llm_async(SMART_MODEL, *AI_engine.summary_prompt(search_content, topic))
+
+async def generate_outline_async(topic: str, summary: str, format_type: str, target_pages: int) -> list:
+    content = await call_llm_async(SMART_MODEL, *AI_engine.outline_prompt(topic, summary, format_type, target_pages))
+    return AI_engine.parse_outline(content)
+
+async def generate_chart_async(summary: str, topic: str) -> str:
+    try:
+        content = await call_llm_async(SMART_MODEL, *AI_engine.chart_prompt(summary, topic))
+        chart_data = AI_engine.parse_chart_data(content)
+        if not chart_data: return None
+        return await _offload(AI_engine.render_chart, chart_data, topic)
+    except Exception as e:
+        print(f"Chart Gen Error: {e}")
+        return None
+
+async def critique_and_refine_async(section_text: str, topic: str) -> str:
+    critique = await call_llm_async(SMART_MODEL, *AI_engine.critique_prompt(section_text, topic))
+    if AI_engine.critique_passes(critique): return section_text
+
+    new_data = await get_search_results_async(critique, max_results=2)
+    if "Error" in new_data or "No results" in new_data: return section_text
+
+    return await call_llm_async(SMART_MODEL, *AI_engine.refine_prompt(section_text, new_data))
+
+async def write_section_async(section_title: str, topic: str, summary: str, word_limit: int, allow_critique: bool = True) -> str:
+    content = await call_llm_async(SMART_MODEL, *AI_engine.section_prompt(section_title, topic, summary, word_limit))
+
+    if word_limit > 400 and "Error" not in content and allow_critique:
+        content = await critique_and_refine_async(content, topic)
+
+    return clean_section_output(content, section_title)
+
+# --- ORCHESTRATOR ---
+# Database and Redis helpers are blocking, so they run via asyncio.to_thread (which carries the
+# budget/cancel context along) rather than on the loop itself.
+
+async def _checkpointer_async(task_id: str = None):
+    done = await asyncio.to_thread(database.get_checkpoints, task_id) if task_id else {}
+    if done: print(f"   >>> Resuming {task_id} from checkpoints: {', '.join(sorted(done))}")
+
+    async def checkpointed(stage: str, produce):
+        if stage in done: return done[stage]
+        value = await produce()
+        if task_id: await asyncio.to_thread(database.save_checkpoint, task_id, stage, value)
+        return value
+    return checkpointed
+
+def _timed(progress: AI_engine.ReportProgress, stage: str, produce):
+    async def _run():
+        start = time.time()
+        with AI_engine.trace_stage(stage), tracing.span(f"stage.{stage}", tier=progress.tier):
+            value = await produce()
+        duration = time.time() - start
+        await asyncio.to_thread(database.record_stage_timing, stage, progress.tier, progress.model, duration)
+        metrics.observe_stage(stage, progress.tier, duration)
+        return value
+    return _run
+
+async def _status(progress: AI_engine.ReportProgress, stage: str, message: str, sections_done: int = None):
+    await asyncio.to_thread(progress.update, stage, message, sections_done)
+
+async def _run_pipeline(query: str, user_format: str, page_count: int, task_id: str, progress: AI_engine.ReportProgress) -> tuple:
+    budget = current_budget()
+    checkpointed = await _checkpointer_async(task_id)
+
+    await _status(progress, "search", "Step 1/6: Global Search (Deep Reading)...")
+    search_content = await checkpointed("search", _timed(progress, "search", lambda: get_search_results_async(query)))
+
+    await _status(progress, "summary", "Step 2/6: Synthesizing...")
+    summary = await checkpointed("summary", _timed(progress, "summary", lambda: generate_summary_async(search_content, query)))
+
+    await _status(progress, "chart", "Step 3/6: Visualizing Data...")
+    async def _chart():
+        if budget.remaining() >= CHART_MIN_SECONDS:
+            return await _timed(progress, "chart", lambda: generate_chart_async(summary, query))()
+        budget.degrade("skipped_chart")
+        return None
+    chart_path = await checkpointed("chart", _chart)
+
+    await _status(progress, "outline", "Step 4/6: Planning Structure...")
+    outline = await checkpointed("outline", _timed(progress, "outline", lambda: generate_outline_async(query, summary, user_format, page_count)))
+    progress.sections_total = len(outline)
+
+    total_words = page_count * WORDS_PER_PAGE
+    words_per_section = max(300, int(total_words / max(1, len(outline))))
+
+    # Sections are independent, so up to ASYNC_SECTION_CONCURRENCY of them are written at once.
+    semaphore = asyncio.Semaphore(ASYNC_SECTION_CONCURRENCY)
+    finished = 0
+    async def _write(index: int, section: str) -> str:
+        nonlocal finished
+        async with semaphore:
+            async def _section():
+                waves_left = math.ceil((len(outline) - finished) / ASYNC_SECTION_CONCURRENCY)
+                word_limit, allow_critique = AI_engine.plan_section(budget, waves_left, words_per_section)
+                return await write_section_async(section, query, summary, word_limit, allow_critique)
+            content = await checkpointed(f"section:{index}", _timed(progress, "section", _section))
+            finished += 1
+            await _status(progress, "section", f"Step 5/6: Researching & Writing... {finished}/{len(outline)} sections done", finished)
+            return content
+
+    await _status(progress, "section", f"Step 5/6: Researching & Writing 0/{len(outline)}...", 0)
+    writers = [asyncio.ensure_future(_write(i, section)) for i, section in enumerate(outline)]
+    try:
+        sections = await asyncio.gather(*writers)
+    except BaseException:
+        for writer in writers: writer.cancel()
+        raise
+
+    await _status(progress, "finalize", "Step 6/6: Finalizing...")
+    return search_content, AI_engine.assemble_report(query, outline, list(sections)), chart_path
+
+async def _watch_cancel(task_id: str, pipeline: asyncio.Task):
+    """Cancelling the pipeline task aborts every in-flight request of this report immediately."""
+    cancel = AI_engine.CancelToken(task_id)
+    while not pipeline.done():
+        await asyncio.sleep(CANCEL_POLL_SECONDS)
+        if await asyncio.to_thread(cancel.cancelled, True):
+            pipeline.cancel()
+            return
+
+async def run_ai_engine_async(query: str, user_format: str, page_count: int = 15, task=None, task_id: str = None, time_budget: int = None) -> tuple[str, str, str, list]:
+    if not query: return "No query.", "", None, []
+
+    format_data = get_template_instructions(user_format, page_count)
+    progress = await asyncio.to_thread(AI_engine.ReportProgress, task, format_data["tier"], format_data["target_sections"], SMART_MODEL, task_id, ASYNC_SECTION_CONCURRENCY)
+    with AI_engine.report_budget(time_budget or format_data["time_budget"]) as budget, AI_engine.cancel_scope(task_id):
+        pipeline = asyncio.ensure_future(_run_pipeline(query, user_format, page_count, task_id, progress))
+        watcher = asyncio.ensure_future(_watch_cancel(task_id, pipeline)) if task_id else None
+        try:
+            search_content, full_report, chart_path = await pipeline
+        except asyncio.CancelledError:
+            if watcher and pipeline.cancelled(): raise ReportCancelled(f"Report {task_id} was cancelled.")
+            raise
+        finally:
+            if watcher: watcher.cancel()
+        return search_content, full_report, chart_path, budget.degradations
+
+def run_report(query: str, user_format: str, page_count: int = 15, task=None, time_budget: int = None) -> tuple[str, str, str, list]:
+    """Blocking entry point with the signature of run_ai_engine_with_return, for Celery worker threads."""
+    task_id = task.request.id if task else None  # task.request is thread-local: read it on the calling thread
+    future = asyncio.run_coroutine_threadsafe(
+        run_ai_engine_async(query, user_format, page_count, task, task_id, time_budget), get_loop()
+    )
+    return future.result()
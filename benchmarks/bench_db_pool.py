@@ -0,0 +1,110 @@
+"""
+SQLite pragma profile and request-scoped sessions: baseline vs tuned.
+
+    python benchmarks/bench_db_pool.py --writes 2000 --requests 500
+
+Runs against throwaway SQLite databases. The write test commits one chat message per
+transaction (the chat and checkpoint pattern); the request test performs the database calls
+of one sidebar + history page load, with a session per call vs one session per request.
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/bench.db")
+os.environ.setdefault("TRACE_EXPORT_PATH", "")
+
+from sqlalchemy import create_engine, event
+import database
+
+# The profile before tuning: WAL and foreign keys, everything else at SQLite's defaults.
+BASELINE_PRAGMAS = {
+    "journal_mode": "WAL", "synchronous": "FULL", "foreign_keys": "ON", "busy_timeout": 0,
+    "cache_size": -2000, "mmap_size": 0, "temp_store": "DEFAULT"
+}
+
+def make_engine(pragmas: dict):
+    engine = create_engine(f"sqlite:///{tempfile.mkdtemp()}/bench.db", connect_args={"check_same_thread": False})
+
+    # Instance listeners run after database.py's global Engine listener, so these pragmas win.
+    @event.listens_for(engine, "connect")
+    def _pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+    engine.checkouts = 0
+
+    @event.listens_for(engine, "checkout")
+    def _checkout(*args):
+        engine.checkouts += 1
+
+    database.Base.metadata.create_all(bind=engine)
+    return engine
+
+def use(engine):
+    database.SessionLocal.configure(bind=engine)
+    database._folder_tree.clear()
+
+def seed(engine):
+    use(engine)
+    folder = database.create_folder("Bench")
+    session = database.create_chat_session(folder.id, "Bench chat")
+    for i in range(200):
+        database.save_report(f"Topic {i}", "x" * 2000)
+    return session.id
+
+def writes(session_id: int, n: int):
+    for i in range(n):
+        database.save_chat_message(session_id, "user", f"message {i}")
+
+def page_load(session_id: int, db=None):
+    database._folder_tree.clear()  # measure the database, not the folder cache
+    database.get_folders_with_sessions(db=db)
+    database.get_reports_page(50, db=db)
+    database.get_session_messages(session_id, 50, db=db)
+    database.get_report_content(1, db=db)
+
+def requests_per_call(session_id: int, n: int):
+    for _ in range(n):
+        page_load(session_id)
+
+def requests_scoped(session_id: int, n: int):
+    for _ in range(n):
+        db = next(gen := database.get_db())
+        page_load(session_id, db)
+        gen.close()
+
+def run(label: str, engine, fn, *args):
+    use(engine)
+    engine.checkouts = 0
+    start = time.perf_counter()
+    fn(*args)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<34} {elapsed * 1000:9.1f} ms   pool checkouts {engine.checkouts}")
+    return elapsed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--writes", type=int, default=2000, help="single-row commits")
+    parser.add_argument("--requests", type=int, default=500, help="simulated page loads")
+    args = parser.parse_args()
+
+    baseline, tuned = make_engine(BASELINE_PRAGMAS), make_engine(database.SQLITE_PRAGMAS)
+    with baseline.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA synchronous").scalar() == 2, "baseline pragmas not applied"
+    baseline_session, tuned_session = seed(baseline), seed(tuned)
+
+    print(f"{args.writes} single-row commits")
+    slow = run("  baseline pragmas", baseline, writes, baseline_session, args.writes)
+    fast = run("  tuned pragmas", tuned, writes, tuned_session, args.writes)
+    print(f"  speed-up {slow / fast:.1f}x\n")
+
+    print(f"{args.requests} page loads (4 queries each), tuned pragmas")
+    slow = run("  session per call", tuned, requests_per_call, tuned_session, args.requests)
+    fast = run("  session per request", tuned, requests_scoped, tuned_session, args.requests)
+    print(f"  speed-up {slow / fast:.1f}x")
@@ -0,0 +1,86 @@
+"""
+Sidebar folder tree: legacy N+1 lazy loading vs the single joined query vs the cached tree.
+
+    python benchmarks/bench_folders.py --folders 2000 --sessions 5
+
+Runs against a throwaway SQLite database unless DATABASE_URL is already set.
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+from datetime import datetime, timezone, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/bench.db")
+os.environ.setdefault("TRACE_EXPORT_PATH", "")
+
+from sqlalchemy import event
+import database
+from database import SessionLocal, ProjectFolder, ChatSession
+
+queries = 0
+
+@event.listens_for(database.engine, "before_cursor_execute")
+def _count(*args):
+    global queries
+    queries += 1
+
+def seed(folders: int, sessions: int):
+    now = datetime.now(timezone.utc)
+    db = SessionLocal()
+    try:
+        db.query(ChatSession).delete()
+        db.query(ProjectFolder).delete()
+        db.bulk_insert_mappings(ProjectFolder, [
+            {"id": f, "name": f"Folder {f}", "created_at": now - timedelta(minutes=f)} for f in range(1, folders + 1)
+        ])
+        db.bulk_insert_mappings(ChatSession, [
+            {"folder_id": f, "title": f"Chat {f}.{s}", "created_at": now - timedelta(minutes=f, seconds=s)}
+            for f in range(1, folders + 1) for s in range(sessions)
+        ])
+        db.commit()
+    finally:
+        db.close()
+
+def legacy_folders_with_sessions():
+    """The pre-optimisation implementation: one lazy sessions query per folder, sorted in Python."""
+    db = SessionLocal()
+    try:
+        folders = db.query(ProjectFolder).order_by(ProjectFolder.created_at.desc()).all()
+        return [{
+            "id": f.id, "name": f.name,
+            "sessions": [{"id": s.id, "title": s.title} for s in sorted(f.sessions, key=lambda s: s.created_at, reverse=True)]
+        } for f in folders]
+    finally:
+        db.close()
+
+def run(label: str, fn, repeat: int, before=None):
+    global queries
+    timings = []
+    for _ in range(repeat):
+        if before: before()
+        queries = 0
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    print(f"{label:<28} median {timings[len(timings) // 2] * 1000:9.2f} ms   best {timings[0] * 1000:9.2f} ms   queries/call {queries}")
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--folders", type=int, default=2000)
+    parser.add_argument("--sessions", type=int, default=5, help="sessions per folder")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    database.init_db()
+    seed(args.folders, args.sessions)
+    print(f"{args.folders} folders x {args.sessions} sessions on {database.engine.url.get_backend_name()}\n")
+
+    legacy = run("legacy (N+1)", legacy_folders_with_sessions, args.repeat)
+    joined = run("joined query (cold cache)", database.get_folders_with_sessions, args.repeat, before=database._folder_tree.clear)
+    cached = run("joined query (warm cache)", database.get_folders_with_sessions, args.repeat)
+    assert legacy == joined == cached, "implementations disagree"
@@ -0,0 +1,97 @@
+import time
+import threading
+from collections import OrderedDict
+
+# In-process caches for hot read paths. Each cache lives in one process, so the CRUD
+# functions that write the underlying rows must invalidate it; the TTL bounds staleness
+# from writers in other processes (e.g. a second API replica).
+
+class LRUCache:
+    """Thread-safe LRU map with an optional per-entry TTL and hit/miss counters."""
+
+    def __init__(self, name: str, maxsize: int = 128, ttl: float = None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0  # bumped on every invalidation; lets a reader drop a value computed before a write
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _lookup(self, key):
+        """The live entry for key (marked most recently used), or None; caller holds the lock."""
+        entry = self._data.get(key)
+        if entry is not None and (self.ttl is None or time.monotonic() - entry[1] < self.ttl):
+            self._data.move_to_end(key)
+            return entry
+        if entry is not None: del self._data[key]
+        return None
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, generation: int = None):
+        with self._lock:
+            if generation is not None and generation != self.generation: return
+            self._data[key] = (value, time.monotonic())
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+            self.generation += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.generation += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "name": self.name, "size": len(self._data), "maxsize": self.maxsize, "hits": self.hits,
+                "misses": self.misses, "hit_rate": round(self.hits / lookups, 3) if lookups else None
+            }
+
+class RecentItemsCache(LRUCache):
+    """LRU of per-key windows holding the newest `window` items (oldest first), e.g. a chat
+    session's latest messages. Writers append to the window, so readers never go stale on it."""
+
+    def __init__(self, name: str, maxsize: int = 128, ttl: float = None, window: int = 100):
+        super().__init__(name, maxsize, ttl)
+        self.window = window
+
+    def page(self, key, limit: int):
+        """(newest `limit` items, whether older ones exist), or None if the window cannot answer."""
+        with self._lock:
+            entry = self._lookup(key)
+            items, complete = entry[0] if entry else ([], False)
+            if len(items) >= limit or (entry and complete):
+                self.hits += 1
+                return items[-limit:], len(items) > limit or not complete
+            self.misses += 1
+            return None
+
+    def fill(self, key, items: list, complete: bool, generation: int = None):
+        """Caches the newest items for key; complete means nothing older exists."""
+        self.set(key, (items[-self.window:], complete and len(items) <= self.window), generation)
+
+    def append(self, key, items: list):
+        """Write-through for new items; also bumps the generation so a fill read before the write is dropped."""
+        with self._lock:
+            self.generation += 1
+            entry = self._lookup(key)
+            if entry is None: return
+            cached, complete = entry[0]
+            merged = cached + list(items)
+            self._data[key] = ((merged[-self.window:], complete and len(merged) <= self.window), time.monotonic())
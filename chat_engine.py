@@ -1,13 +1,33 @@
 import os
 import json
+import time
+import asyncio
 import httpx # NEW LIBRARY
+import metrics
+import async_database
 
 LLAMA_MODEL_STRING = "nvidia/nemotron-nano-12b-v2-vl:free" 
 
-async def get_chat_response_async(user_message: str, history: list) -> str:
+_trace_writes = set()  # keeps pending trace writes referenced until they finish
+
+def _trace(latency: float, outcome: str, usage: dict = None, session_id: int = None):
+    # The llm_traces row is written in the background: a /chat reply never waits on its commit.
+    metrics.observe_llm(LLAMA_MODEL_STRING, latency, outcome, usage)
+    write = asyncio.ensure_future(
+        async_database.record_llm_trace(LLAMA_MODEL_STRING, "chat", latency, outcome, 1, usage, session_id=session_id)
+    )
+    _trace_writes.add(write)
+    write.add_done_callback(_trace_writes.discard)
+
+async def flush_traces():
+    """Waits for trace writes still in flight (on shutdown)."""
+    if _trace_writes: await asyncio.gather(*_trace_writes, return_exceptions=True)
+
+async def get_chat_response_async(user_message: str, history: list, session_id: int = None) -> str:
     """
     Async version of chat response using HTTPX.
     """
+    start = None
     try:
         api_key = os.environ.get("OPENROUTER_API_KEY")
         if not api_key: return "Error: OPENROUTER_API_KEY environment variable not set."
@@ -24,6 +44,7 @@ async def get_chat_response_async(user_message: str, history: list) -> str:
 
         messages.append({"role": "user", "content": user_message})
 
+        start = time.time()
         async with httpx.AsyncClient() as client:
             response = await client.post(
                 url="https://openrouter.ai/api/v1/chat/completions",
@@ -31,11 +52,16 @@ async def get_chat_response_async(user_message: str, history: list) -> str:
                 data=json.dumps({"model": LLAMA_MODEL_STRING, "messages": messages, "temperature": 0.7}),
                 timeout=30.0
             )
+            if response.is_error:  # raise_for_status() below; every other outcome is traced once
+                _trace(time.time() - start, f"http_{response.status_code}", session_id=session_id)
             response.raise_for_status()
             result = response.json()
-            return result['choices'][0]['message']['content'] or "No response from AI."
+            reply = result['choices'][0]['message']['content']
+            _trace(time.time() - start, "ok", result.get('usage'), session_id)
+            return reply or "No response from AI."
 
     except httpx.HTTPStatusError as e:
-        return f"API Error: {e.response.status_code}"
+        return f"API Error: {e.response.status_code}"  # traced above with its status
     except Exception as e:
+        if start is not None: _trace(time.time() - start, "error", session_id=session_id)
         return f"An unexpected error occurred: {e}"
\ No newline at end of file
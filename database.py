@@ -1,8 +1,16 @@
 import os
-from datetime import datetime, timezone
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, ForeignKey, event, text
-from sqlalchemy.orm import sessionmaker, relationship, declarative_base
+import json
+import zlib
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timezone, timedelta
+from sqlalchemy import create_engine, inspect, select, func, or_, and_, Column, Integer, Float, Boolean, String, Text, LargeBinary, DateTime, ForeignKey, UniqueConstraint, Index, event, text, bindparam
+from sqlalchemy.orm import Session, sessionmaker, relationship, declarative_base, deferred, undefer_group
 from sqlalchemy.engine import Engine
+from sqlalchemy.schema import DDL, CreateIndex, CreateTable
+import metrics
+import tracing
+import cache
 
 # 1. SETUP
 DB_FOLDER = "/app/data"
@@ -14,51 +22,122 @@ SQLALCHEMY_DATABASE_URL = os.environ.get(
     f"sqlite:///{DB_FOLDER}/scholarforge.db"
 )
 
+# Server databases: a bounded pool, connections validated on checkout (pre-ping) and
+# recycled before server/proxy idle timeouts can kill them.
+POOL_OPTIONS = {
+    "pool_size": int(os.environ.get("DB_POOL_SIZE", 10)),
+    "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", 20)),
+    "pool_timeout": int(os.environ.get("DB_POOL_TIMEOUT", 30)),
+    "pool_recycle": int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+    "pool_pre_ping": True
+}
+
+# SQLite: WAL with synchronous=NORMAL (durable at checkpoints, no fsync per commit), a 64 MB
+# page cache, 256 MB of memory-mapped reads, in-memory temp tables, and a busy timeout so
+# concurrent writers wait instead of failing with "database is locked".
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "foreign_keys": "ON",  # SQLite ignores ON DELETE CASCADE without it
+    "busy_timeout": 5000,
+    "cache_size": -64000,
+    "mmap_size": 268435456,
+    "temp_store": "MEMORY"
+}
+
 if "sqlite" in SQLALCHEMY_DATABASE_URL:
     engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
     @event.listens_for(Engine, "connect")
     def set_sqlite_pragma(dbapi_connection, connection_record):
         cursor = dbapi_connection.cursor()
-        cursor.execute("PRAGMA journal_mode=WAL")
+        for name, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name}={value}")
         cursor.close()
 else:
-    engine = create_engine(SQLALCHEMY_DATABASE_URL)
+    engine = create_engine(SQLALCHEMY_DATABASE_URL, **POOL_OPTIONS)
+
+metrics.instrument_engine(engine)
+tracing.instrument_engine(engine)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
 # 2. MODELS
+REPORT_COMPRESSION_LEVEL = int(os.environ.get("REPORT_COMPRESSION_LEVEL", 6))
+
+def _compressed_text(text_attr: str, z_attr: str) -> property:
+    """Text stored zlib-compressed in z_attr; rows written before compression still hold it in text_attr."""
+    def _get(self):
+        compressed = getattr(self, z_attr)
+        return zlib.decompress(compressed).decode("utf-8") if compressed is not None else getattr(self, text_attr)
+    def _set(self, value):
+        setattr(self, z_attr, compress_report(value))
+        setattr(self, text_attr, None)
+    return property(_get, _set)
+
 class ReportDB(Base):
     __tablename__ = "reports"
     id = Column(Integer, primary_key=True, index=True)
     topic = Column(String, index=True)
-    content = Column(Text)
+    # The body is stored zlib-compressed in content_z and only loaded when asked for (the "body"
+    # deferred group), so listings and deletes never read it. Rows written before compression
+    # keep their plain text in the legacy "content" column until init_db() migrates them.
+    content_text = deferred(Column("content", Text), group="body")
+    content_z = deferred(Column(LargeBinary), group="body")
     created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    # Pipeline artifacts, kept here instead of in the Celery result backend. The scraped sources
+    # and the summary are compressed the same way, in their own "artifacts" group: only section
+    # regeneration and ?include_sources=true read them.
+    search_content_text = deferred(Column("search_content", Text), group="artifacts")
+    search_content_z = deferred(Column(LargeBinary), group="artifacts")
+    summary_text = deferred(Column("summary", Text), group="artifacts")
+    summary_z = deferred(Column(LargeBinary), group="artifacts")
+    outline = Column(Text)  # JSON list of section titles
+    chart_path = Column(String)
+    __table_args__ = (Index("ix_reports_created", "created_at", "id"),)
+
+    content = _compressed_text("content_text", "content_z")
+    search_content = _compressed_text("search_content_text", "search_content_z")
+    summary = _compressed_text("summary_text", "summary_z")
+
+def compress_report(content: str) -> bytes:
+    return zlib.compress(content.encode("utf-8"), REPORT_COMPRESSION_LEVEL) if content is not None else None
+
+def _report_body(content_z: bytes, content: str) -> str:
+    return zlib.decompress(content_z).decode("utf-8") if content_z is not None else content
+
+# Case-insensitive topic prefix search is a range scan over lower(topic) in byte order
+# ("C" in Postgres, BINARY in SQLite), so prefix bounds match exactly.
+TOPIC_COLLATION = "C" if engine.dialect.name == "postgresql" else "BINARY"
+Index("ix_reports_topic_prefix", func.lower(ReportDB.topic).collate(TOPIC_COLLATION))
 
 class ProjectFolder(Base):
     __tablename__ = "project_folders"
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, unique=True)
-    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
-    sessions = relationship("ChatSession", back_populates="folder", cascade="all, delete-orphan")
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc), index=True)
+    # Children are removed by the database (ON DELETE CASCADE), never loaded just to be deleted.
+    sessions = relationship("ChatSession", back_populates="folder", cascade="all, delete-orphan", passive_deletes=True)
 
 class ChatSession(Base):
     __tablename__ = "chat_sessions"
     id = Column(Integer, primary_key=True, index=True)
-    folder_id = Column(Integer, ForeignKey("project_folders.id")) 
+    folder_id = Column(Integer, ForeignKey("project_folders.id", ondelete="CASCADE"))
     title = Column(String)
     created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
     folder = relationship("ProjectFolder", back_populates="sessions")
-    messages = relationship("ChatMessage", back_populates="session", cascade="all, delete-orphan")
+    messages = relationship("ChatMessage", back_populates="session", cascade="all, delete-orphan", passive_deletes=True)
+    __table_args__ = (Index("ix_chat_sessions_folder_created", "folder_id", "created_at"),)
 
 class ChatMessage(Base):
     __tablename__ = "chat_messages"
     id = Column(Integer, primary_key=True, index=True)
-    session_id = Column(Integer, ForeignKey("chat_sessions.id"))
+    session_id = Column(Integer, ForeignKey("chat_sessions.id", ondelete="CASCADE"))
     role = Column(String)
     content = Column(Text)
     created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
     session = relationship("ChatSession", back_populates="messages")
+    __table_args__ = (Index("ix_chat_messages_session_created", "session_id", "created_at", "id"),)
 
 class Hook(Base):
     __tablename__ = "hooks"
@@ -66,174 +145,756 @@ class Hook(Base):
     content = Column(Text)
     created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
 
+class ReportCheckpoint(Base):
+    __tablename__ = "report_checkpoints"
+    id = Column(Integer, primary_key=True, index=True)
+    task_id = Column(String, index=True)
+    stage = Column(String)  # "search", "summary", "chart", "outline", "section:<n>"
+    content = Column(Text)  # JSON-encoded stage output
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    __table_args__ = (UniqueConstraint("task_id", "stage", name="uq_checkpoint_task_stage"),)
+
+class ReportCancellation(Base):
+    __tablename__ = "report_cancellations"
+    task_id = Column(String, primary_key=True)
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
+class StageTiming(Base):
+    __tablename__ = "stage_timings"
+    id = Column(Integer, primary_key=True, index=True)
+    stage = Column(String)  # "search", "summary", "chart", "outline", "section", "finalize"
+    tier = Column(String)   # page_count tier from report_formats
+    model = Column(String)
+    duration = Column(Float)  # seconds
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    __table_args__ = (Index("ix_stage_timings_lookup", "tier", "model", "stage", "created_at"),)
+
+class LLMTrace(Base):
+    __tablename__ = "llm_traces"
+    id = Column(Integer, primary_key=True, index=True)
+    model = Column(String)
+    stage = Column(String)     # pipeline stage, "chat" for chat completions
+    report_id = Column(String) # report task ID
+    session_id = Column(Integer)
+    attempt = Column(Integer)  # 1 = primary model, 2 = backup fallback
+    outcome = Column(String)   # "ok", "http_<status>", "error"
+    cache_hit = Column(Boolean, default=False)
+    prompt_tokens = Column(Integer)
+    completion_tokens = Column(Integer)
+    latency = Column(Float)    # seconds
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    __table_args__ = (Index("ix_llm_traces_created", "created_at"),)
+
 # 3. INIT
+def _upgrade_schema():
+    """create_all() never alters existing tables, so add any model columns and indexes an older database lacks."""
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name): continue
+            existing = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing: continue
+                col_type = column.type.compile(dialect=engine.dialect)
+                conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {col_type}'))
+                print(f"DB Upgrade: added {table.name}.{column.name}")
+            for index in table.indexes:
+                # IF NOT EXISTS rather than checkfirst: reflection cannot see expression indexes.
+                conn.execute(CreateIndex(index, if_not_exists=True))
+
+def _rebuild_sqlite_table(table, old_columns: set):
+    """SQLite cannot alter constraints: copy into a table built from the model, then swap it in."""
+    columns = ", ".join(c.name for c in table.columns if c.name in old_columns)
+    ddl = str(CreateTable(table).compile(engine)).replace(f"CREATE TABLE {table.name} ", f"CREATE TABLE {table.name}_new ", 1)
+    with engine.connect() as conn:
+        conn.exec_driver_sql("PRAGMA foreign_keys=OFF")
+        conn.commit()
+        with conn.begin():
+            conn.exec_driver_sql(ddl)
+            conn.exec_driver_sql(f"INSERT INTO {table.name}_new ({columns}) SELECT {columns} FROM {table.name}")
+            conn.exec_driver_sql(f"DROP TABLE {table.name}")
+            conn.exec_driver_sql(f"ALTER TABLE {table.name}_new RENAME TO {table.name}")
+        conn.exec_driver_sql("PRAGMA foreign_keys=ON")
+        conn.commit()
+
+def _add_delete_cascades():
+    """Databases created before ON DELETE CASCADE get their foreign keys re-created with it."""
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name): continue
+        reflected = inspector.get_foreign_keys(table.name)
+        def _current(fk):
+            return [r for r in reflected if r["constrained_columns"] == [fk.parent.name]]
+        missing = [fk for fk in table.foreign_keys if fk.ondelete and not any(
+            (r.get("options") or {}).get("ondelete", "").upper() == fk.ondelete.upper() for r in _current(fk)
+        )]
+        if not missing: continue
+        if engine.dialect.name == "sqlite":
+            _rebuild_sqlite_table(table, {c["name"] for c in inspector.get_columns(table.name)})
+        else:
+            with engine.begin() as conn:
+                for fk in missing:
+                    for r in _current(fk):
+                        if r.get("name"): conn.execute(text(f'ALTER TABLE {table.name} DROP CONSTRAINT {r["name"]}'))
+                    conn.execute(text(
+                        f'ALTER TABLE {table.name} ADD FOREIGN KEY ({fk.parent.name}) '
+                        f'REFERENCES {fk.column.table.name} ({fk.column.name}) ON DELETE {fk.ondelete}'
+                    ))
+        print(f"DB Upgrade: {table.name} foreign keys now ON DELETE CASCADE")
+
+def _compress_legacy_reports(batch: int = 200):
+    """Moves plain-text report bodies and artifacts into their compressed columns, a batch per transaction."""
+    table = ReportDB.__table__
+    for text_column, z_column in [("content", "content_z"), ("search_content", "search_content_z"), ("summary", "summary_z")]:
+        moved = 0
+        with SessionLocal() as db:
+            while True:
+                rows = db.execute(select(table.c.id, table.c[text_column]).where(
+                    table.c[z_column].is_(None), table.c[text_column].isnot(None)
+                ).limit(batch)).all()
+                if not rows: break
+                db.execute(table.update().where(table.c.id == bindparam("rid")).values({text_column: None, z_column: bindparam("z")}),
+                           [{"rid": rid, "z": compress_report(value)} for rid, value in rows])
+                db.commit()
+                moved += len(rows)
+        if moved: print(f"DB Upgrade: compressed {moved} reports.{text_column} values")
+
+# Full-text search. The database cannot decompress report bodies, so reports are indexed from
+# application code on both backends. SQLite: reports_fts is a contentless FTS5 table written by
+# _index_report/_unindex_reports, and chat_messages_fts reads its text from chat_messages, kept in
+# step by triggers. Postgres: an app-maintained reports.search_vector column and a GIN index on
+# to_tsvector(content) for messages.
+SEARCH_LANGUAGE = "english"
+
+_MESSAGE_FTS_DELETE = "INSERT INTO chat_messages_fts(chat_messages_fts, rowid, content) VALUES ('delete', old.id, old.content)"
+
+SQLITE_SEARCH_DDL = [
+    # Report triggers of earlier versions called an app-registered SQL function other clients lack.
+    "DROP TRIGGER IF EXISTS reports_fts_ai",
+    "DROP TRIGGER IF EXISTS reports_fts_ad",
+    "DROP TRIGGER IF EXISTS reports_fts_au",
+    "CREATE TRIGGER IF NOT EXISTS chat_messages_fts_ai AFTER INSERT ON chat_messages BEGIN "
+    "INSERT INTO chat_messages_fts(rowid, content) VALUES (new.id, new.content); END",
+    f"CREATE TRIGGER IF NOT EXISTS chat_messages_fts_ad AFTER DELETE ON chat_messages BEGIN {_MESSAGE_FTS_DELETE}; END",
+    f"CREATE TRIGGER IF NOT EXISTS chat_messages_fts_au AFTER UPDATE OF content ON chat_messages BEGIN "
+    f"{_MESSAGE_FTS_DELETE}; INSERT INTO chat_messages_fts(rowid, content) VALUES (new.id, new.content); END"
+]
+
+POSTGRES_SEARCH_DDL = [
+    "ALTER TABLE reports ADD COLUMN IF NOT EXISTS search_vector tsvector",
+    "CREATE INDEX IF NOT EXISTS ix_reports_search ON reports USING GIN (search_vector)",
+    f"CREATE INDEX IF NOT EXISTS ix_chat_messages_search ON chat_messages USING GIN (to_tsvector('{SEARCH_LANGUAGE}', content))"
+]
+
+_REPORT_VECTOR_SQL = text(
+    f"UPDATE reports SET search_vector = setweight(to_tsvector('{SEARCH_LANGUAGE}', coalesce(topic, '')), 'A') "
+    f"|| setweight(to_tsvector('{SEARCH_LANGUAGE}', coalesce(:body, '')), 'B') WHERE id = :id"
+)
+
+_REPORT_FTS_INSERT = text("INSERT INTO reports_fts(rowid, topic, body) VALUES (:id, :topic, :body)")
+_REPORT_FTS_DELETE = text("INSERT INTO reports_fts(reports_fts, rowid, topic, body) VALUES ('delete', :id, :topic, :body)")
+
+def _index_report(db: Session, report_id: int, topic: str, content: str):
+    if engine.dialect.name == "postgresql": db.execute(_REPORT_VECTOR_SQL, {"id": report_id, "body": content})
+    elif engine.dialect.name == "sqlite": db.execute(_REPORT_FTS_INSERT, {"id": report_id, "topic": topic, "body": content})
+
+def _unindex_reports(db: Session, report_ids: list) -> dict:
+    """SQLite only: a contentless index drops a row given its old topic and body. Returns {id: topic}."""
+    if engine.dialect.name != "sqlite" or not report_ids: return {}
+    rows = db.execute(select(ReportDB.id, ReportDB.topic, ReportDB.content_z, ReportDB.content_text).where(ReportDB.id.in_(report_ids))).all()
+    if rows: db.execute(_REPORT_FTS_DELETE, [{"id": r.id, "topic": r.topic, "body": _report_body(r.content_z, r.content_text)} for r in rows])
+    return {r.id: r.topic for r in rows}
+
+def _install_search():
+    """Creates the search indexes if missing and fills them from existing rows."""
+    backfill_reports = False
+    with engine.begin() as conn:
+        if engine.dialect.name == "sqlite":
+            tables = {r[0] for r in conn.exec_driver_sql("SELECT name FROM sqlite_master WHERE name LIKE '%_fts'")}
+            if "reports_fts" not in tables:
+                conn.exec_driver_sql("CREATE VIRTUAL TABLE reports_fts USING fts5(topic, body, content='', tokenize='porter unicode61')")
+                backfill_reports = True
+            if "chat_messages_fts" not in tables:
+                conn.exec_driver_sql(
+                    "CREATE VIRTUAL TABLE chat_messages_fts USING fts5(content, content='chat_messages', content_rowid='id', tokenize='porter unicode61')"
+                )
+                conn.exec_driver_sql("INSERT INTO chat_messages_fts(chat_messages_fts) VALUES ('rebuild')")
+            for ddl in SQLITE_SEARCH_DDL: conn.exec_driver_sql(ddl)
+        elif engine.dialect.name == "postgresql":
+            for ddl in POSTGRES_SEARCH_DDL: conn.exec_driver_sql(ddl)
+    if backfill_reports:
+        with SessionLocal() as db:
+            last_id = 0
+            while True:
+                rows = db.execute(select(ReportDB.id, ReportDB.topic, ReportDB.content_z, ReportDB.content_text)
+                                  .where(ReportDB.id > last_id).order_by(ReportDB.id).limit(200)).all()
+                if not rows: break
+                db.execute(_REPORT_FTS_INSERT, [{"id": r.id, "topic": r.topic, "body": _report_body(r.content_z, r.content_text)} for r in rows])
+                db.commit()
+                last_id = rows[-1].id
+    if engine.dialect.name == "postgresql":
+        with SessionLocal() as db:
+            while True:
+                rows = db.execute(text("SELECT id FROM reports WHERE search_vector IS NULL LIMIT 200")).scalars().all()
+                if not rows: break
+                for report in db.scalars(select(ReportDB).options(undefer_group("body")).where(ReportDB.id.in_(rows))):
+                    _index_report(db, report.id, report.topic, report.content)
+                db.commit()
+
+# The FTS5 tables live outside the ORM metadata, so drop_all() (reset-db) must drop them too.
+event.listen(ReportDB.__table__, "after_drop", DDL("DROP TABLE IF EXISTS reports_fts").execute_if(dialect="sqlite"))
+event.listen(ChatMessage.__table__, "after_drop", DDL("DROP TABLE IF EXISTS chat_messages_fts").execute_if(dialect="sqlite"))
+
 def init_db():
     try:
         Base.metadata.create_all(bind=engine)
+        _add_delete_cascades()
+        _upgrade_schema()
+        _install_search()
+        _compress_legacy_reports()
+        pruned = prune_report_state()
+        if pruned: print(f"DB Maintenance: pruned {pruned} stale checkpoint/cancellation rows")
+        clear_caches()
     except Exception as e:
         print(f"DB Init Error: {e}")
 
-# 4. CRUD OPERATIONS
+def clear_caches():
+    for c in caches(): c.clear()
 
-# --- FOLDERS ---
-def create_folder(name: str):
+def caches() -> list:
+    return [_folder_tree, _chat_history, _report_cache]
+
+def release_parent_connections():
+    """Called in freshly forked worker processes: drop (without closing) the pooled connections inherited from the parent."""
+    engine.dispose(close=False)
+
+def warm_up():
+    """Opens this process's first pooled connection."""
+    with engine.connect() as conn:
+        conn.execute(text("SELECT 1"))
+
+# 4. SESSIONS
+def get_db():
+    """FastAPI dependency: one session, and so one pooled connection, for the whole request."""
     db = SessionLocal()
     try:
-        existing = db.query(ProjectFolder).filter(ProjectFolder.name == name).first()
-        if existing: raise Exception("Folder exists")
-        folder = ProjectFolder(name=name)
-        db.add(folder)
-        db.commit()
-        db.refresh(folder)
-        return folder
-    except Exception as e:
-        db.rollback()
-        raise e
+        yield db
     finally:
         db.close()
 
-def rename_folder(folder_id: int, new_name: str):
+@contextmanager
+def _session(db: Session = None):
+    """Uses the caller's (request-scoped) session, or opens and closes a private one."""
+    if db is not None:
+        yield db
+        return
     db = SessionLocal()
     try:
-        folder = db.query(ProjectFolder).filter(ProjectFolder.id == folder_id).first()
-        if folder:
-            folder.name = new_name
-            db.commit()
-            return True
-        return False
+        yield db
     finally:
         db.close()
 
-def delete_folder(folder_id: int):
-    db = SessionLocal()
-    try:
+# 5. CRUD OPERATIONS
+BULK_CHUNK_SIZE = 500  # stays under SQLite's bound-parameter limit
+
+def _chunks(ids: list):
+    ids = list(dict.fromkeys(ids))
+    for i in range(0, len(ids), BULK_CHUNK_SIZE):
+        yield ids[i:i + BULK_CHUNK_SIZE]
+
+# --- FOLDERS ---
+# The sidebar folder tree is read on every page render but changes only through the CRUD below.
+FOLDER_CACHE_TTL = float(os.environ.get("FOLDER_CACHE_TTL", 30))
+_folder_tree = cache.LRUCache("folder_tree", maxsize=1, ttl=FOLDER_CACHE_TTL)
+
+def create_folder(name: str, db: Session = None):
+    with _session(db) as db:
+        try:
+            existing = db.query(ProjectFolder).filter(ProjectFolder.name == name).first()
+            if existing: raise Exception("Folder exists")
+            folder = ProjectFolder(name=name)
+            db.add(folder)
+            db.commit()
+            _folder_tree.clear()
+            db.refresh(folder)
+            return folder
+        except Exception as e:
+            db.rollback()
+            raise e
+
+def rename_folder(folder_id: int, new_name: str, db: Session = None):
+    with _session(db) as db:
         folder = db.query(ProjectFolder).filter(ProjectFolder.id == folder_id).first()
         if folder:
-            db.delete(folder)
+            folder.name = new_name
             db.commit()
+            _folder_tree.clear()
             return True
         return False
-    finally:
-        db.close()
 
-def get_folders_with_sessions():
-    db = SessionLocal()
-    try:
-        folders = db.query(ProjectFolder).order_by(ProjectFolder.created_at.desc()).all()
-        result = []
-        for f in folders:
-            sessions = sorted(f.sessions, key=lambda s: s.created_at, reverse=True)
-            result.append({
-                "id": f.id,
-                "name": f.name,
-                "sessions": [{"id": s.id, "title": s.title} for s in sessions]
-            })
+def delete_folder(folder_id: int, db: Session = None):
+    with _session(db) as db:
+        # One statement: the database cascades to the folder's sessions and their messages.
+        deleted = db.query(ProjectFolder).filter(ProjectFolder.id == folder_id).delete(synchronize_session=False)
+        db.commit()
+        if deleted:
+            _folder_tree.clear()
+            _chat_history.clear()  # cheaper than looking up which sessions the folder held
+        return bool(deleted)
+
+def get_folders_with_sessions(db: Session = None):
+    cached = _folder_tree.get("tree")
+    if cached is not None: return cached
+    generation = _folder_tree.generation
+    with _session(db) as db:
+        # One LEFT JOIN sorted in SQL instead of a lazy sessions load per folder.
+        rows = db.query(ProjectFolder.id, ProjectFolder.name, ChatSession.id, ChatSession.title) \
+            .outerjoin(ChatSession, ChatSession.folder_id == ProjectFolder.id) \
+            .order_by(ProjectFolder.created_at.desc(), ProjectFolder.id.desc(), ChatSession.created_at.desc(), ChatSession.id.desc()) \
+            .all()
+        folders = {}
+        for folder_id, name, session_id, title in rows:
+            folder = folders.setdefault(folder_id, {"id": folder_id, "name": name, "sessions": []})
+            if session_id is not None: folder["sessions"].append({"id": session_id, "title": title})
+        result = list(folders.values())
+        _folder_tree.set("tree", result, generation)
         return result
-    finally:
-        db.close()
 
 # --- SESSIONS ---
-def create_chat_session(folder_id: int, title: str):
-    db = SessionLocal()
-    try:
+# Hot-session cache: the newest CHAT_CACHE_WINDOW messages of the most recently used sessions.
+# Saves append to it after commit, so an active conversation's history (every /chat turn, the
+# chat page) is served from memory; older pages still come from the database.
+CHAT_CACHE_SESSIONS = int(os.environ.get("CHAT_CACHE_SESSIONS", 512))
+CHAT_CACHE_WINDOW = int(os.environ.get("CHAT_CACHE_WINDOW", 100))
+CHAT_CACHE_TTL = float(os.environ.get("CHAT_CACHE_TTL", 300))
+_chat_history = cache.RecentItemsCache("chat_history", maxsize=CHAT_CACHE_SESSIONS, ttl=CHAT_CACHE_TTL, window=CHAT_CACHE_WINDOW)
+
+HistoryMessage = namedtuple("HistoryMessage", "id role content created_at")  # same fields as a page row
+
+def create_chat_session(folder_id: int, title: str, db: Session = None):
+    with _session(db) as db:
         session = ChatSession(folder_id=folder_id, title=title)
         db.add(session)
         db.commit()
+        _folder_tree.clear()
         db.refresh(session)
         return session
-    finally:
-        db.close()
 
-def rename_chat_session(session_id: int, new_title: str):
-    db = SessionLocal()
-    try:
+def rename_chat_session(session_id: int, new_title: str, db: Session = None):
+    with _session(db) as db:
         session = db.query(ChatSession).filter(ChatSession.id == session_id).first()
         if session:
             session.title = new_title
             db.commit()
+            _folder_tree.clear()
+            _chat_history.invalidate(session_id)
             return True
         return False
-    finally:
-        db.close()
 
-def delete_chat_session(session_id: int):
-    db = SessionLocal()
-    try:
-        session = db.query(ChatSession).filter(ChatSession.id == session_id).first()
-        if session:
-            db.delete(session)
+def delete_chat_session(session_id: int, db: Session = None):
+    with _session(db) as db:
+        deleted = db.query(ChatSession).filter(ChatSession.id == session_id).delete(synchronize_session=False)
+        db.commit()
+        _chat_history.invalidate(session_id)
+        if deleted: _folder_tree.clear()
+        return bool(deleted)
+
+def delete_chat_sessions(session_ids: list, db: Session = None) -> int:
+    """Set-based bulk delete of sessions (messages cascade) in one transaction; returns sessions deleted."""
+    with _session(db) as db:
+        try:
+            deleted = 0
+            for chunk in _chunks(session_ids):
+                deleted += db.query(ChatSession).filter(ChatSession.id.in_(chunk)).delete(synchronize_session=False)
             db.commit()
-            return True
-        return False
-    finally:
-        db.close()
+            for session_id in session_ids: _chat_history.invalidate(session_id)
+            if deleted: _folder_tree.clear()
+            return deleted
+        except Exception:
+            db.rollback()
+            raise
 
-def get_session_messages(session_id: int):
-    db = SessionLocal()
-    try:
-        return db.query(ChatMessage).filter(ChatMessage.session_id == session_id).order_by(ChatMessage.created_at.asc()).all()
-    finally:
-        db.close()
+# Keyset pagination on (session_id, created_at, id): each page is one index range scan, however long the session.
+MESSAGE_PAGE_SIZE = 50
 
-def save_chat_message(session_id: int, role: str, content: str):
-    db = SessionLocal()
-    try:
-        msg = ChatMessage(session_id=session_id, role=role, content=content)
-        db.add(msg)
-        db.commit()
-    finally:
-        db.close()
+def session_messages_statement(session_id: int, limit: int, before_id: int = None):
+    """Newest-first page query shared by the sync and async (async_database) data layers; fetches limit + 1 rows."""
+    stmt = select(ChatMessage.id, ChatMessage.role, ChatMessage.content, ChatMessage.created_at) \
+        .where(ChatMessage.session_id == session_id)
+    if before_id is not None:
+        # An unknown cursor makes the subquery NULL, so the page is simply empty.
+        cursor = select(ChatMessage.created_at).where(ChatMessage.id == before_id, ChatMessage.session_id == session_id).scalar_subquery()
+        stmt = stmt.where(or_(ChatMessage.created_at < cursor, and_(ChatMessage.created_at == cursor, ChatMessage.id < before_id)))
+    return stmt.order_by(ChatMessage.created_at.desc(), ChatMessage.id.desc()).limit(limit + 1)
+
+def messages_page(rows: list, limit: int) -> tuple[list, bool]:
+    return rows[:limit][::-1], len(rows) > limit
+
+def cached_messages(session_id: int, limit: int, before_id: int = None):
+    """The page from the hot-session cache, or None (older pages are never cached)."""
+    return _chat_history.page(session_id, limit) if before_id is None else None
+
+def history_fetch_size(limit: int, before_id: int = None) -> int:
+    # A latest-page miss loads the whole cache window so the next reads are hits.
+    return max(limit, CHAT_CACHE_WINDOW) if before_id is None else limit
+
+def history_page(session_id: int, rows: list, limit: int, before_id: int, generation: int) -> tuple[list, bool]:
+    """Builds the page from fetched rows and, for a latest-page read, fills the cache with them."""
+    if before_id is None:
+        fetched = history_fetch_size(limit, before_id)
+        _chat_history.fill(session_id, [HistoryMessage(*r) for r in rows[:fetched][::-1]], len(rows) <= fetched, generation)
+    return messages_page(rows, limit)
+
+def history_snapshot(messages: list) -> dict:
+    """session_id -> HistoryMessage for flushed ChatMessage rows, readable after their session closes."""
+    snapshot = {}
+    for m in messages: snapshot.setdefault(m.session_id, []).append(HistoryMessage(m.id, m.role, m.content, m.created_at))
+    return snapshot
+
+def remember_messages(snapshot: dict):
+    """Write-through, called after the commit: new messages join their sessions' cached windows."""
+    for session_id, items in snapshot.items(): _chat_history.append(session_id, items)
+
+def get_session_messages(session_id: int, limit: int = MESSAGE_PAGE_SIZE, before_id: int = None, db: Session = None) -> tuple[list, bool]:
+    """The newest `limit` messages before message `before_id` (oldest first), and whether older ones exist."""
+    cached = cached_messages(session_id, limit, before_id)
+    if cached is not None: return cached
+    generation = _chat_history.generation
+    with _session(db) as db:
+        rows = db.execute(session_messages_statement(session_id, history_fetch_size(limit, before_id), before_id)).all()
+        return history_page(session_id, rows, limit, before_id, generation)
+
+def _save_messages(db: Session, messages: list):
+    db.add_all(messages)
+    db.flush()  # assigns ids and created_at, so the snapshot needs no reload after commit
+    snapshot = history_snapshot(messages)
+    db.commit()
+    remember_messages(snapshot)
+
+def save_chat_message(session_id: int, role: str, content: str, db: Session = None):
+    with _session(db) as db:
+        _save_messages(db, [ChatMessage(session_id=session_id, role=role, content=content)])
+
+def chat_turn_rows(session_id: int, user_message: str, assistant_message: str, created_at: datetime = None) -> list:
+    # Same timestamp for both; the id (insert order) keeps the user message first.
+    created_at = created_at or datetime.now(timezone.utc)
+    return [
+        ChatMessage(session_id=session_id, role="user", content=user_message, created_at=created_at),
+        ChatMessage(session_id=session_id, role="assistant", content=assistant_message, created_at=created_at)
+    ]
+
+def save_chat_turn(session_id: int, user_message: str, assistant_message: str, db: Session = None):
+    """Both messages of a chat turn in one transaction: one commit, and never half a turn."""
+    with _session(db) as db:
+        _save_messages(db, chat_turn_rows(session_id, user_message, assistant_message))
 
 # --- REPORTS ---
-def save_report(topic: str, content: str):
-    db = SessionLocal()
-    try:
-        new_report = ReportDB(topic=topic, content=content)
+def save_report(topic: str, content: str, search_content: str = None, summary: str = None, outline: list = None, chart_path: str = None, db: Session = None) -> int:
+    with _session(db) as db:
+        new_report = ReportDB(
+            topic=topic, content=content, search_content=search_content, summary=summary,
+            outline=json.dumps(outline) if outline is not None else None, chart_path=chart_path
+        )
         db.add(new_report)
+        db.flush()
+        _index_report(db, new_report.id, topic, content)
         db.commit()
-    finally:
-        db.close()
+        return new_report.id
 
-def get_all_reports():
-    db = SessionLocal()
-    try:
-        return db.query(ReportDB.id, ReportDB.topic, ReportDB.created_at).order_by(ReportDB.created_at.desc()).all()
-    finally:
-        db.close()
+REPORT_PAGE_SIZE = 50
 
-def get_report_content(report_id: int):
-    db = SessionLocal()
-    try:
-        return db.query(ReportDB).filter(ReportDB.id == report_id).first()
-    finally:
-        db.close()
+def get_reports_page(limit: int = REPORT_PAGE_SIZE, before_id: int = None, topic_prefix: str = None,
+                     date_from: datetime = None, date_to: datetime = None, db: Session = None) -> tuple[list, bool]:
+    """Newest-first report listing keyed on (created_at, id), and whether more pages exist."""
+    with _session(db) as db:
+        query = db.query(ReportDB.id, ReportDB.topic, ReportDB.created_at)
+        if before_id is not None:
+            cursor = db.query(ReportDB.created_at).filter(ReportDB.id == before_id).scalar()
+            if cursor is None: return [], False
+            query = query.filter(or_(ReportDB.created_at < cursor, and_(ReportDB.created_at == cursor, ReportDB.id < before_id)))
+        if topic_prefix:
+            prefix = topic_prefix.lower()
+            topic = func.lower(ReportDB.topic).collate(TOPIC_COLLATION)
+            query = query.filter(topic >= prefix, topic < prefix[:-1] + chr(ord(prefix[-1]) + 1))
+        if date_from: query = query.filter(ReportDB.created_at >= date_from)
+        if date_to: query = query.filter(ReportDB.created_at < date_to)
+        rows = query.order_by(ReportDB.created_at.desc(), ReportDB.id.desc()).limit(limit + 1).all()
+        return rows[:limit], len(rows) > limit
 
-def delete_report(report_id: int):
-    db = SessionLocal()
-    try:
+def report_statement(report_id: int, artifacts: bool = False):
+    """The report with its body (and, if asked, search_content and summary); decompressed on first access."""
+    groups = [undefer_group("body")] + ([undefer_group("artifacts")] if artifacts else [])
+    return select(ReportDB).options(*groups).where(ReportDB.id == report_id)
+
+def get_report_content(report_id: int, artifacts: bool = False, db: Session = None):
+    with _session(db) as db:
+        return db.scalars(report_statement(report_id, artifacts)).first()
+
+# Read cache for the history viewer: opening a report from history (again and again) costs no
+# query and no decompression. Only API reads go through it; workers always read the database,
+# since another process may have rewritten the report (see invalidate_cached_report).
+REPORT_CACHE_SIZE = int(os.environ.get("REPORT_CACHE_SIZE", 64))
+REPORT_CACHE_TTL = float(os.environ.get("REPORT_CACHE_TTL", 600))
+_report_cache = cache.LRUCache("reports", maxsize=REPORT_CACHE_SIZE, ttl=REPORT_CACHE_TTL)
+
+ReportView = namedtuple("ReportView", "id topic content chart_path outline")
+
+def get_cached_report(report_id: int, db: Session = None):
+    """get_report_content() behind the read cache, as a ReportView with the body already decompressed."""
+    view = _report_cache.get(report_id)
+    if view is not None: return view
+    generation = _report_cache.generation
+    report = get_report_content(report_id, db=db)
+    if not report: return None
+    view = ReportView(report.id, report.topic, report.content, report.chart_path, report.outline)
+    _report_cache.set(report_id, view, generation)
+    return view
+
+def invalidate_cached_report(report_id: int):
+    """For writes made by another process (a worker regenerating a section)."""
+    _report_cache.invalidate(report_id)
+
+def update_report_content(report_id: int, content: str, db: Session = None) -> bool:
+    with _session(db) as db:
+        topic = _unindex_reports(db, [report_id]).get(report_id)
+        updated = db.query(ReportDB).filter(ReportDB.id == report_id).update(
+            {ReportDB.content_z: compress_report(content), ReportDB.content_text: None}
+        )
+        if updated: _index_report(db, report_id, topic, content)
+        db.commit()
+        _report_cache.invalidate(report_id)
+        return bool(updated)
+
+def delete_report(report_id: int, db: Session = None):
+    with _session(db) as db:
         report = db.query(ReportDB).filter(ReportDB.id == report_id).first()
         if report:
+            _unindex_reports(db, [report_id])
             db.delete(report)
             db.commit()
+            _report_cache.invalidate(report_id)
             return True
         return False
-    finally:
-        db.close()
 
-def delete_all_reports():
-    db = SessionLocal()
-    try:
+def delete_reports(report_ids: list, db: Session = None) -> int:
+    """One DELETE ... WHERE id IN (...) per chunk, all in a single transaction; returns rows deleted."""
+    with _session(db) as db:
+        try:
+            deleted = 0
+            for chunk in _chunks(report_ids):
+                _unindex_reports(db, chunk)
+                deleted += db.query(ReportDB).filter(ReportDB.id.in_(chunk)).delete(synchronize_session=False)
+            db.commit()
+            for report_id in report_ids: _report_cache.invalidate(report_id)
+            return deleted
+        except Exception:
+            db.rollback()
+            raise
+
+def delete_all_reports(db: Session = None):
+    with _session(db) as db:
         db.query(ReportDB).delete()
+        if engine.dialect.name == "sqlite": db.execute(text("INSERT INTO reports_fts(reports_fts) VALUES ('delete-all')"))
         db.commit()
+        _report_cache.clear()
         return True
-    finally:
-        db.close()
 
-def save_hook(content: str):
-    db = SessionLocal()
-    try:
+def save_hook(content: str, db: Session = None):
+    with _session(db) as db:
         new_hook = Hook(content=content)
         db.add(new_hook)
         db.commit()
-    finally:
-        db.close()
\ No newline at end of file
+
+# --- SEARCH ---
+SEARCH_PAGE_SIZE = 20
+
+def _fts_query(q: str) -> str:
+    """User input as an FTS5 query: every word must match, the last one as a prefix (search-as-you-type)."""
+    words = [w.replace('"', '""') for w in q.split()]
+    return " ".join(f'"{w}"' for w in words[:-1]) + (f' "{words[-1]}"*' if words else "")
+
+def search_reports(q: str, limit: int = SEARCH_PAGE_SIZE, offset: int = 0, db: Session = None) -> tuple[list, bool]:
+    """Reports ranked by relevance (topic matches weigh more than body matches), and whether more pages exist."""
+    if not q.strip(): return [], False
+    with _session(db) as db:
+        if engine.dialect.name == "postgresql":
+            sql = text(
+                f"SELECT r.id, r.topic, r.created_at, ts_rank(r.search_vector, query) AS rank "
+                f"FROM reports r, websearch_to_tsquery('{SEARCH_LANGUAGE}', :q) query WHERE r.search_vector @@ query "
+                f"ORDER BY rank DESC, r.id DESC LIMIT :limit OFFSET :offset"
+            )
+            params = {"q": q}
+        else:
+            sql = text(
+                "SELECT r.id, r.topic, r.created_at, -bm25(reports_fts, 10.0, 1.0) AS rank "
+                "FROM reports_fts JOIN reports r ON r.id = reports_fts.rowid WHERE reports_fts MATCH :q "
+                "ORDER BY rank DESC, r.id DESC LIMIT :limit OFFSET :offset"
+            )
+            params = {"q": _fts_query(q)}
+        rows = db.execute(sql.columns(created_at=DateTime), {**params, "limit": limit + 1, "offset": offset}).all()
+        return rows[:limit], len(rows) > limit
+
+def search_messages(q: str, limit: int = SEARCH_PAGE_SIZE, offset: int = 0, db: Session = None) -> tuple[list, bool]:
+    """Chat messages ranked by relevance, each with its session title and a snippet with the matches in **bold**."""
+    if not q.strip(): return [], False
+    with _session(db) as db:
+        if engine.dialect.name == "postgresql":
+            sql = text(
+                f"SELECT m.id, m.session_id, s.title, m.role, m.created_at, "
+                f"ts_headline('{SEARCH_LANGUAGE}', m.content, query, 'StartSel=**, StopSel=**, MaxWords=24, MinWords=8') AS snippet, "
+                f"ts_rank(to_tsvector('{SEARCH_LANGUAGE}', m.content), query) AS rank "
+                f"FROM chat_messages m JOIN chat_sessions s ON s.id = m.session_id, websearch_to_tsquery('{SEARCH_LANGUAGE}', :q) query "
+                f"WHERE to_tsvector('{SEARCH_LANGUAGE}', m.content) @@ query ORDER BY rank DESC, m.id DESC LIMIT :limit OFFSET :offset"
+            )
+            params = {"q": q}
+        else:
+            sql = text(
+                "SELECT m.id, m.session_id, s.title, m.role, m.created_at, "
+                "snippet(chat_messages_fts, 0, '**', '**', '...', 24) AS snippet, -bm25(chat_messages_fts) AS rank "
+                "FROM chat_messages_fts JOIN chat_messages m ON m.id = chat_messages_fts.rowid JOIN chat_sessions s ON s.id = m.session_id "
+                "WHERE chat_messages_fts MATCH :q ORDER BY rank DESC, m.id DESC LIMIT :limit OFFSET :offset"
+            )
+            params = {"q": _fts_query(q)}
+        rows = db.execute(sql.columns(created_at=DateTime), {**params, "limit": limit + 1, "offset": offset}).all()
+        return rows[:limit], len(rows) > limit
+
+# --- REPORT CHECKPOINTS ---
+def save_checkpoint(task_id: str, stage: str, value, db: Session = None):
+    with _session(db) as db:
+        try:
+            db.query(ReportCheckpoint).filter(ReportCheckpoint.task_id == task_id, ReportCheckpoint.stage == stage).delete()
+            db.add(ReportCheckpoint(task_id=task_id, stage=stage, content=json.dumps(value)))
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            print(f"Checkpoint Save Error ({task_id}/{stage}): {e}")
+
+def get_checkpoints(task_id: str, db: Session = None) -> dict:
+    with _session(db) as db:
+        rows = db.query(ReportCheckpoint.stage, ReportCheckpoint.content).filter(ReportCheckpoint.task_id == task_id).all()
+        return {stage: json.loads(content) for stage, content in rows}
+
+# Checkpoints only serve a redelivery of the same task ID (a worker lost mid-report), so they are
+# dropped together with the cancellation flag once the task finishes, fails or is cancelled.
+REPORT_STATE_MAX_AGE_DAYS = int(os.environ.get("REPORT_STATE_MAX_AGE_DAYS", 7))
+
+def clear_report_state(task_id: str, db: Session = None):
+    with _session(db) as db:
+        db.query(ReportCheckpoint).filter(ReportCheckpoint.task_id == task_id).delete(synchronize_session=False)
+        db.query(ReportCancellation).filter(ReportCancellation.task_id == task_id).delete(synchronize_session=False)
+        db.commit()
+
+def prune_report_state(max_age_days: int = REPORT_STATE_MAX_AGE_DAYS, db: Session = None) -> int:
+    """Removes state of tasks that never got to clear it (revoked while queued, lost for good); returns rows deleted."""
+    cutoff = datetime.now(timezone.utc) - timedelta(days=max_age_days)
+    with _session(db) as db:
+        deleted = db.query(ReportCheckpoint).filter(ReportCheckpoint.created_at < cutoff).delete(synchronize_session=False)
+        deleted += db.query(ReportCancellation).filter(ReportCancellation.created_at < cutoff).delete(synchronize_session=False)
+        db.commit()
+        return deleted
+
+def count_checkpoints(task_id: str, prefix: str = "", db: Session = None) -> int:
+    with _session(db) as db:
+        return db.query(func.count(ReportCheckpoint.id)).filter(
+            ReportCheckpoint.task_id == task_id, ReportCheckpoint.stage.startswith(prefix)
+        ).scalar()
+
+# --- CANCELLATION ---
+def request_cancel(task_id: str, db: Session = None):
+    with _session(db) as db:
+        db.merge(ReportCancellation(task_id=task_id))
+        db.commit()
+
+def is_cancelled(task_id: str, db: Session = None) -> bool:
+    with _session(db) as db:
+        return db.query(ReportCancellation.task_id).filter(ReportCancellation.task_id == task_id).first() is not None
+
+# --- STAGE TIMINGS (ETA history) ---
+STAGE_TIMING_WINDOW_DAYS = 30
+
+def record_stage_timing(stage: str, tier: str, model: str, duration: float, db: Session = None):
+    with _session(db) as db:
+        try:
+            db.add(StageTiming(stage=stage, tier=tier, model=model, duration=duration))
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            print(f"Stage Timing Error: {e}")
+
+def get_stage_estimates(tier: str = None, model: str = None, db: Session = None) -> list:
+    """Mean stage duration over the recent window, grouped by tier, model and stage."""
+    with _session(db) as db:
+        since = datetime.now(timezone.utc) - timedelta(days=STAGE_TIMING_WINDOW_DAYS)
+        query = db.query(
+            StageTiming.tier, StageTiming.model, StageTiming.stage,
+            func.avg(StageTiming.duration), func.count(StageTiming.id)
+        ).filter(StageTiming.created_at >= since)
+        if tier: query = query.filter(StageTiming.tier == tier)
+        if model: query = query.filter(StageTiming.model == model)
+        rows = query.group_by(StageTiming.tier, StageTiming.model, StageTiming.stage).all()
+        return [{"tier": t, "model": m, "stage": st, "seconds": round(avg, 2), "samples": n} for t, m, st, avg, n in rows]
+
+# --- LLM TRACES ---
+def llm_trace_row(model: str, stage: str, latency: float, outcome: str, attempt: int = 1, usage: dict = None,
+                  report_id: str = None, session_id: int = None, cache_hit: bool = False) -> LLMTrace:
+    usage = usage or {}
+    return LLMTrace(
+        model=model, stage=stage, report_id=report_id, session_id=session_id, attempt=attempt, outcome=outcome,
+        cache_hit=cache_hit, prompt_tokens=usage.get("prompt_tokens"), completion_tokens=usage.get("completion_tokens"),
+        latency=latency
+    )
+
+def record_llm_trace(*args, **kwargs):
+    with _session() as db:
+        try:
+            db.add(llm_trace_row(*args, **kwargs))
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            print(f"LLM Trace Error: {e}")
+
+def _percentile(values: list, q: float) -> float:
+    if not values: return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(q * len(values)))], 3)
+
+def get_llm_trace_summary(hours: int = 24 * 7, db: Session = None) -> dict:
+    """Latency percentiles and token use by stage and model, plus tokens per report, over the last `hours`."""
+    with _session(db) as db:
+        since = datetime.now(timezone.utc) - timedelta(hours=hours)
+        rows = db.query(
+            LLMTrace.stage, LLMTrace.model, LLMTrace.report_id, LLMTrace.attempt, LLMTrace.outcome,
+            LLMTrace.cache_hit, LLMTrace.prompt_tokens, LLMTrace.completion_tokens, LLMTrace.latency
+        ).filter(LLMTrace.created_at >= since).all()
+
+    def _group(key) -> list:
+        groups = {}
+        for r in rows: groups.setdefault(key(r), []).append(r)
+        return [{
+            "key": k,
+            "calls": len(g),
+            "p50_seconds": _percentile([r.latency for r in g], 0.5),
+            "p95_seconds": _percentile([r.latency for r in g], 0.95),
+            "prompt_tokens": sum(r.prompt_tokens or 0 for r in g),
+            "completion_tokens": sum(r.completion_tokens or 0 for r in g),
+            "fallback_rate": round(sum(1 for r in g if r.attempt > 1) / len(g), 3),
+            "error_rate": round(sum(1 for r in g if r.outcome != "ok") / len(g), 3),
+            "cache_hit_rate": round(sum(1 for r in g if r.cache_hit) / len(g), 3)
+        } for k, g in groups.items()]
+
+    per_report = {}
+    for r in rows:
+        if r.report_id: per_report[r.report_id] = per_report.get(r.report_id, 0) + (r.prompt_tokens or 0) + (r.completion_tokens or 0)
+    tokens = list(per_report.values())
+    return {
+        "hours": hours,
+        "calls": len(rows),
+        "by_stage": sorted(_group(lambda r: r.stage or "unknown"), key=lambda g: -g["calls"]),
+        "by_model": sorted(_group(lambda r: r.model), key=lambda g: -g["calls"]),
+        "tokens_per_report": {
+            "reports": len(tokens),
+            "mean": round(sum(tokens) / len(tokens)) if tokens else None,
+            "p50": _percentile(tokens, 0.5),
+            "p95": _percentile(tokens, 0.95)
+        }
+    }
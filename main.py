@@ -1,23 +1,30 @@
 import os
+import json
 import shutil
 import urllib.parse
+import time
 import tempfile
+from datetime import date, datetime, timedelta
 from dotenv import load_dotenv
 load_dotenv()
-from fastapi import FastAPI, Request, Form, BackgroundTasks, HTTPException
+from fastapi import FastAPI, Request, Form, BackgroundTasks, HTTPException, Depends
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, Response
 from starlette.middleware.sessions import SessionMiddleware
 from pydantic import BaseModel
+from sqlalchemy.orm import Session
 from celery.result import AsyncResult
 
 # Import modules
-from task import generate_report_task, celery_app
+from task import generate_report_task, regenerate_section_task, celery_app, REDIS_URL, REPORT_QUEUES, MAX_PRIORITY
 import AI_engine 
 import chat_engine 
 import report_formats
 import database 
+import async_database
+import metrics
+import tracing
 
 app = FastAPI(title="ScholarForge")
 
@@ -54,12 +61,23 @@ def startup():
     # --- 2. DATABASE INIT ---
     database.init_db()
 
+    # --- 3. METRICS ---
+    metrics.expose_queue_depth(REDIS_URL, list(REPORT_QUEUES.values()), MAX_PRIORITY + 1)
+    metrics.expose_caches(database.caches())
+
+@app.on_event("shutdown")
+async def shutdown():
+    await async_database.flush_chat_writes()
+    await chat_engine.flush_traces()
+    await async_database.dispose()
+
 # --- PYDANTIC MODELS ---
 class ReportRequest(BaseModel):
     query: str
     format_key: str
     format_content: str = None
     page_count: int = 15
+    time_budget: int = None  # seconds; defaults to the page_count tier budget
 
 class ChatRequest(BaseModel):
     message: str
@@ -75,6 +93,13 @@ class CreateSessionRequest(BaseModel):
     folder_id: int
     title: str
 
+class RegenerateSectionRequest(BaseModel):
+    section: str
+    time_budget: int = None
+
+class BulkDeleteRequest(BaseModel):
+    ids: list[int]
+
 class HookRequest(BaseModel):
     content: str
 
@@ -95,79 +120,113 @@ def reset_database():
         # Nuclear option for Postgres: Drop all tables via SQLAlchemy metadata
         database.engine.dispose()
         database.Base.metadata.drop_all(bind=database.engine)
+        database.clear_caches()
         database.init_db()
         return {"status": "success", "message": "Database reset (Tables dropped and recreated)."}
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
 
+@app.get("/metrics")
+def metrics_endpoint():
+    body, content_type = metrics.render()
+    return Response(content=body, media_type=content_type)
+
+@app.get("/api/system/llm-traces")
+def get_llm_traces(hours: int = 24 * 7, db: Session = Depends(database.get_db)):
+    # p50/p95 latency and tokens by stage and model, tokens per report: where caching or cheaper models pay off.
+    return database.get_llm_trace_summary(hours, db=db)
+
+@app.get("/api/system/cache-stats")
+def get_cache_stats():
+    return [c.stats() for c in database.caches()]
+
+@app.get("/api/system/stage-timings")
+def get_stage_timings(tier: str = None, model: str = None, db: Session = Depends(database.get_db)):
+    return database.get_stage_estimates(tier, model, db=db)
+
 # --- FOLDER & CHAT API ---
 
 @app.get("/api/folders")
-def get_folders():
-    return database.get_folders_with_sessions()
+def get_folders(db: Session = Depends(database.get_db)):
+    return database.get_folders_with_sessions(db=db)
 
 @app.post("/api/folders")
-def create_new_folder(data: CreateFolderRequest):
+def create_new_folder(data: CreateFolderRequest, db: Session = Depends(database.get_db)):
     try:
-        folder = database.create_folder(data.name)
+        folder = database.create_folder(data.name, db=db)
         return {"status": "success", "folder": {"id": folder.id, "name": folder.name, "sessions": []}}
     except Exception as e:
         return JSONResponse(status_code=400, content={"error": str(e)})
 
 @app.put("/api/folders/{folder_id}")
-def rename_folder_api(folder_id: int, data: RenameRequest):
-    if database.rename_folder(folder_id, data.new_name):
+def rename_folder_api(folder_id: int, data: RenameRequest, db: Session = Depends(database.get_db)):
+    if database.rename_folder(folder_id, data.new_name, db=db):
         return {"status": "success"}
     return JSONResponse(status_code=404, content={"error": "Not found"})
 
 @app.delete("/api/folders/{folder_id}")
-def delete_folder_api(folder_id: int):
-    if database.delete_folder(folder_id):
+def delete_folder_api(folder_id: int, db: Session = Depends(database.get_db)):
+    if database.delete_folder(folder_id, db=db):
         return {"status": "success"}
     return JSONResponse(status_code=404, content={"error": "Not found"})
 
 @app.post("/api/sessions")
-def create_new_session(data: CreateSessionRequest):
+def create_new_session(data: CreateSessionRequest, db: Session = Depends(database.get_db)):
     try:
-        session = database.create_chat_session(data.folder_id, data.title)
+        session = database.create_chat_session(data.folder_id, data.title, db=db)
         return {"status": "success", "session": {"id": session.id, "title": session.title}}
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
 
 @app.put("/api/sessions/{session_id}")
-def rename_session_api(session_id: int, data: RenameRequest):
-    if database.rename_chat_session(session_id, data.new_name):
+def rename_session_api(session_id: int, data: RenameRequest, db: Session = Depends(database.get_db)):
+    if database.rename_chat_session(session_id, data.new_name, db=db):
         return {"status": "success"}
     return JSONResponse(status_code=404, content={"error": "Not found"})
 
 @app.delete("/api/sessions/{session_id}")
-def delete_session_api(session_id: int):
-    if database.delete_chat_session(session_id):
+def delete_session_api(session_id: int, db: Session = Depends(database.get_db)):
+    if database.delete_chat_session(session_id, db=db):
         return {"status": "success"}
     return JSONResponse(status_code=404, content={"error": "Not found"})
 
+@app.post("/api/sessions/bulk-delete")
+def bulk_delete_sessions(data: BulkDeleteRequest, db: Session = Depends(database.get_db)):
+    return {"status": "success", "deleted": database.delete_chat_sessions(data.ids, db=db)}
+
 @app.get("/api/sessions/{session_id}/messages")
-def get_session_history(session_id: int):
-    msgs = database.get_session_messages(session_id)
-    return [{"role": m.role, "content": m.content} for m in msgs]
+async def get_session_history(session_id: int, limit: int = database.MESSAGE_PAGE_SIZE, before_id: int = None):
+    # Async layer: it flushes this session's write-behind turns (CHAT_WRITE_BEHIND) before reading.
+    msgs, has_more = await async_database.get_session_messages(session_id, min(max(limit, 1), 200), before_id)
+    return {
+        "messages": [{"id": m.id, "role": m.role, "content": m.content} for m in msgs],
+        "has_more": has_more,
+        "next_before_id": msgs[0].id if has_more else None
+    }
 
 @app.post("/chat")
 async def handle_chat(data: ChatRequest):
-    db_messages = database.get_session_messages(data.session_id)
+    db_messages = await async_database.get_all_session_messages(data.session_id)
     history_context = [{"role": m.role, "content": m.content} for m in db_messages]
     
-    ai_response = await chat_engine.get_chat_response_async(data.message, history_context)
+    ai_response = await chat_engine.get_chat_response_async(data.message, history_context, data.session_id)
     
-    database.save_chat_message(data.session_id, "user", data.message)
-    database.save_chat_message(data.session_id, "assistant", ai_response)
+    await async_database.save_chat_turn(data.session_id, data.message, ai_response)
     
     return {'response': ai_response}
 
 # --- REPORT API ---
 
 @app.get("/api/history")
-def get_history():
-    reports = database.get_all_reports()
+def get_history(limit: int = database.REPORT_PAGE_SIZE, before_id: int = None, q: str = None,
+                date_from: date = None, date_to: date = None, db: Session = Depends(database.get_db)):
+    # date_to is inclusive: reports created any time on that day are returned.
+    reports, has_more = database.get_reports_page(
+        min(max(limit, 1), 200), before_id, q.strip() if q else None,
+        datetime.combine(date_from, datetime.min.time()) if date_from else None,
+        datetime.combine(date_to + timedelta(days=1), datetime.min.time()) if date_to else None,
+        db=db
+    )
     data = []
     for r in reports:
         data.append({
@@ -175,31 +234,63 @@ def get_history():
             "topic": r.topic, 
             "date": r.created_at.strftime("%b %d, %H:%M")
         })
-    return data
+    return {"reports": data, "has_more": has_more, "next_before_id": reports[-1].id if has_more else None}
+
+@app.get("/api/search")
+def search(q: str, scope: str = "reports", limit: int = database.SEARCH_PAGE_SIZE, offset: int = 0, db: Session = Depends(database.get_db)):
+    # Ranked full-text search over report topics/bodies (scope=reports) or chat messages (scope=messages).
+    limit, offset = min(max(limit, 1), 100), max(offset, 0)
+    if scope == "messages":
+        rows, has_more = database.search_messages(q, limit, offset, db=db)
+        results = [{
+            "id": m.id, "session_id": m.session_id, "session_title": m.title, "role": m.role,
+            "snippet": m.snippet, "date": m.created_at.strftime("%b %d, %H:%M")
+        } for m in rows]
+    elif scope == "reports":
+        rows, has_more = database.search_reports(q, limit, offset, db=db)
+        results = [{"id": r.id, "topic": r.topic, "date": r.created_at.strftime("%b %d, %H:%M")} for r in rows]
+    else:
+        return JSONResponse(status_code=400, content={"error": "scope must be 'reports' or 'messages'"})
+    return {"results": results, "has_more": has_more, "next_offset": offset + limit if has_more else None}
 
 @app.get("/api/report/{id}")
-def get_report(id: int):
-    report = database.get_report_content(id)
+def get_report(id: int, db: Session = Depends(database.get_db)):
+    report = database.get_cached_report(id, db=db)
     if report:
-        return {"topic": report.topic, "content": report.content}
+        return {"topic": report.topic, "content": report.content, "chart_path": report.chart_path}
     return {"error": "Not found"}
 
+@app.post("/api/report/{id}/regenerate-section")
+def regenerate_section(id: int, data: RegenerateSectionRequest, db: Session = Depends(database.get_db)):
+    # Poll /report-status/{task_id} as for a full report; SUCCESS returns the updated content.
+    report = database.get_cached_report(id, db=db)
+    if not report:
+        return JSONResponse(status_code=404, content={"error": "Report not found"})
+    if report.outline and data.section not in json.loads(report.outline):
+        return JSONResponse(status_code=404, content={"error": f"Section '{data.section}' not in report outline"})
+    task = regenerate_section_task.delay(id, data.section, data.time_budget)
+    return {"task_id": task.id}
+
 @app.delete("/api/report/{id}")
-def delete_report_endpoint(id: int):
-    success = database.delete_report(id)
+def delete_report_endpoint(id: int, db: Session = Depends(database.get_db)):
+    success = database.delete_report(id, db=db)
     if success:
         return {"status": "success", "message": "Report deleted"}
     return JSONResponse(status_code=404, content={"error": "Report not found"})
 
+@app.post("/api/reports/bulk-delete")
+def bulk_delete_reports(data: BulkDeleteRequest, db: Session = Depends(database.get_db)):
+    return {"status": "success", "deleted": database.delete_reports(data.ids, db=db)}
+
 @app.delete("/api/reports/all")
-def delete_all_reports_endpoint():
-    success = database.delete_all_reports()
+def delete_all_reports_endpoint(db: Session = Depends(database.get_db)):
+    success = database.delete_all_reports(db=db)
     if success:
         return {"status": "success"}
     return JSONResponse(status_code=500, content={"error": "Failed"})
 
 @app.post("/start-report")
-async def start_report(data: ReportRequest):
+async def start_report(data: ReportRequest, request: Request):
     try:
         if not data.query:
             return JSONResponse({'error': 'No query provided'}, status_code=400)
@@ -210,36 +301,79 @@ async def start_report(data: ReportRequest):
                 return JSONResponse({'error': 'Custom format selected but no content provided.'}, status_code=400)
             user_format = "custom" 
 
-        task = generate_report_task.delay(data.query, user_format, data.page_count)
-        return {"task_id": task.id}
+        # The trace follows the task through its Celery headers; clients may continue their own via traceparent.
+        parent = tracing.extract(request.headers.get("traceparent"))
+        with tracing.span("POST /start-report", parent, kind=2, **{"report.format": user_format, "report.pages": data.page_count}) as (trace_id, _):
+            task = generate_report_task.delay(data.query, user_format, data.page_count, data.time_budget)
+        return {"task_id": task.id, "trace_id": trace_id}
         
     except Exception as e:
         return JSONResponse({'error': f'Failed to start task: {str(e)}'}, status_code=500)
 
 @app.get("/report-status/{task_id}")
-async def report_status(task_id: str):
+async def report_status(task_id: str, include_sources: bool = False):
     task = AsyncResult(task_id, app=celery_app)
 
     if task.state == 'PENDING':
         return {'status': 'PENDING', 'message': 'Task is in queue...'}
     elif task.state == 'PROGRESS':
-        message = task.info.get('message', 'Task is running...')
-        return {'status': 'PROGRESS', 'message': message}
+        info = task.info or {}
+        return {
+            'status': 'PROGRESS',
+            'message': info.get('message', 'Task is running...'),
+            'stage': info.get('stage'),
+            'section': info.get('section'),
+            'sections_total': info.get('sections_total'),
+            'percent': info.get('percent'),
+            'eta_seconds': info.get('eta_seconds')
+        }
     elif task.state == 'SUCCESS':
         result = task.result
         if isinstance(result, dict) and result.get('status') == 'FAILURE':
             return {'status': 'FAILURE', 'error': result.get('error')}
-        return {
+        if isinstance(result, dict) and result.get('status') == 'CANCELLED':
+            return {'status': 'CANCELLED'}
+        if isinstance(result, dict) and 'report_id' not in result:
+            # Results stored before report bodies moved to the database carry the content inline.
+            response = {
+                'status': 'SUCCESS',
+                'report_id': None,
+                'report_content': result.get('report_content'),
+                'chart_path': result.get('chart_path'),
+                'degradations': result.get('degradations', [])
+            }
+            if include_sources:
+                response['search_content'] = result.get('search_content')
+            return response
+        # The task result only carries the report ID; the body is loaded from the DB on demand.
+        # A worker may just have rewritten it (section regeneration), so drop any cached copy.
+        database.invalidate_cached_report(result.get('report_id'))
+        report = await async_database.get_report_content(result.get('report_id'), artifacts=include_sources)
+        if not report:
+            return {'status': 'FAILURE', 'error': 'Report not found.'}
+        response = {
             'status': 'SUCCESS',
-            'report_content': result.get('report_content'),
-            'search_content': result.get('search_content'),
-            'chart_path': result.get('chart_path')
+            'report_id': report.id,
+            'report_content': report.content,
+            'chart_path': result.get('chart_path'),
+            'degradations': result.get('degradations', [])
         }
+        if include_sources:
+            response['search_content'] = report.search_content
+        return response
     elif task.state == 'FAILURE':
         return {'status': 'FAILURE', 'error': str(task.info)}
     else:
         return {'status': task.state}
 
+@app.post("/cancel-report/{task_id}")
+def cancel_report(task_id: str, db: Session = Depends(database.get_db)):
+    # Queued tasks are revoked outright; running ones see the flag at their next stage,
+    # section or in-flight HTTP poll and stop; their checkpoints are cleared with the task.
+    database.request_cancel(task_id, db=db)
+    celery_app.control.revoke(task_id)
+    return {"status": "success", "message": "Cancellation requested"}
+
 # --- FILE OPS ---
 
 def cleanup_file(path: str):
@@ -275,6 +409,7 @@ def send_converted_file(report_content, topic, format_type, chart_path, backgrou
 
     result = "Error"
     media_type = "text/plain"
+    start = time.time()
     filename = f"{safe_topic}_Report.{format_type}"
 
     if format_type == 'pdf':
@@ -297,6 +432,7 @@ def send_converted_file(report_content, topic, format_type, chart_path, backgrou
         raise HTTPException(status_code=400, detail="Invalid format.")
 
     if result.startswith("Success"):
+        metrics.observe_conversion(format_type, time.time() - start)
         background_tasks.add_task(cleanup_file, temp_filepath)
         return FileResponse(path=temp_filepath, filename=filename, media_type=media_type)
     else:
@@ -306,7 +442,7 @@ def send_converted_file(report_content, topic, format_type, chart_path, backgrou
 @app.post("/add-hook")
 async def add_hook(data: HookRequest):
     try:
-        database.save_hook(data.content)
+        await async_database.save_hook(data.content)
         return {'status': 'success', 'message': 'Hook saved!'}
     except Exception as e:
         return {'status': 'error', 'message': str(e)}
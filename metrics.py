@@ -0,0 +1,136 @@
+import os
+import time
+from urllib.parse import urlparse
+import redis
+from sqlalchemy import event
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Histogram, CONTENT_TYPE_LATEST, generate_latest, start_http_server
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client import multiprocess
+
+# Prometheus metrics shared by the API and the Celery workers. Prefork workers record from
+# several child processes, so workers set PROMETHEUS_MULTIPROC_DIR: every process writes its
+# samples there and the worker exporter aggregates the directory on each scrape.
+
+# --- CONFIG ---
+MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+WORKER_METRICS_PORT = int(os.environ.get("WORKER_METRICS_PORT", 9100))
+
+if MULTIPROC_DIR: os.makedirs(MULTIPROC_DIR, exist_ok=True)
+
+FAST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+SLOW_BUCKETS = (0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 45, 60, 90, 120, 180, 300, 600, 900)
+
+# --- METRICS ---
+STAGE_SECONDS = Histogram("scholarforge_stage_seconds", "Report pipeline stage duration", ["stage", "tier"], buckets=SLOW_BUCKETS)
+LLM_SECONDS = Histogram("scholarforge_llm_seconds", "LLM completion latency", ["model", "outcome"], buckets=SLOW_BUCKETS)
+LLM_TOKENS = Counter("scholarforge_llm_tokens", "LLM tokens used", ["model", "kind"])
+LLM_RETRIES = Counter("scholarforge_llm_retries", "LLM calls retried on the backup model", ["model"])
+SCRAPE_SECONDS = Histogram("scholarforge_scrape_seconds", "Source page fetch and extraction time", ["host", "outcome"], buckets=SLOW_BUCKETS)
+DB_QUERY_SECONDS = Histogram("scholarforge_db_query_seconds", "Database statement latency", ["operation"], buckets=FAST_BUCKETS)
+CONVERSION_SECONDS = Histogram("scholarforge_conversion_seconds", "Report file conversion time", ["format"], buckets=FAST_BUCKETS + SLOW_BUCKETS[5:])
+
+def observe_stage(stage: str, tier: str, seconds: float):
+    STAGE_SECONDS.labels(stage, tier).observe(seconds)
+
+def observe_llm(model: str, seconds: float, outcome: str, usage: dict = None):
+    LLM_SECONDS.labels(model, outcome).observe(seconds)
+    for kind in ("prompt_tokens", "completion_tokens"):
+        if usage and usage.get(kind): LLM_TOKENS.labels(model, kind.split("_")[0]).inc(usage[kind])
+
+def observe_retry(model: str):
+    LLM_RETRIES.labels(model).inc()
+
+def observe_scrape(url: str, seconds: float, outcome: str):
+    SCRAPE_SECONDS.labels(urlparse(url).hostname or "unknown", outcome).observe(seconds)
+
+def observe_conversion(format_type: str, seconds: float):
+    CONVERSION_SECONDS.labels(format_type).observe(seconds)
+
+# --- DATABASE ---
+def instrument_engine(engine):
+    """Times every statement on the engine via cursor events, labelled by SQL verb."""
+    # The start time lives on the statement's execution context, so a statement that fails
+    # (no after_cursor_execute) leaves nothing behind to be paired with a later one.
+    @event.listens_for(engine, "before_cursor_execute")
+    def _start(conn, cursor, statement, parameters, context, executemany):
+        if context is not None: context.metrics_query_start = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _stop(conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, "metrics_query_start", None)
+        if started is None: return
+        operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "UNKNOWN"
+        DB_QUERY_SECONDS.labels(operation).observe(time.perf_counter() - started)
+
+# --- QUEUE DEPTH ---
+class QueueDepthCollector:
+    """Reads Celery queue lengths straight from Redis at scrape time (one key per priority level)."""
+
+    def __init__(self, redis_url: str, queues: list, priority_steps: int):
+        self.client = redis.Redis.from_url(redis_url, socket_timeout=2)
+        self.queues = queues
+        self.priority_steps = priority_steps
+
+    def _family(self):
+        return GaugeMetricFamily("scholarforge_queue_depth", "Messages waiting in each report queue", labels=["queue"])
+
+    def describe(self):
+        yield self._family()  # lets the registry check names without a Redis round-trip
+
+    def collect(self):
+        gauge = self._family()
+        try:
+            for queue in self.queues:
+                keys = [queue] + [f"{queue}:{p}" for p in range(1, self.priority_steps)]
+                pipe = self.client.pipeline()
+                for key in keys: pipe.llen(key)
+                gauge.add_metric([queue], sum(pipe.execute()))
+        except redis.RedisError as e:
+            print(f"[metrics] Queue depth unavailable: {e}")
+        yield gauge
+
+# --- CACHES ---
+class CacheCollector:
+    """Hit/miss counters and sizes of in-process cache.LRUCache instances, read at scrape time.
+    Hit rate: rate(scholarforge_cache_hits_total[5m]) / (rate(..._hits_total[5m]) + rate(..._misses_total[5m]))."""
+
+    def __init__(self, caches: list):
+        self.caches = caches
+
+    def collect(self):
+        hits = CounterMetricFamily("scholarforge_cache_hits", "In-process cache hits", labels=["cache"])
+        misses = CounterMetricFamily("scholarforge_cache_misses", "In-process cache misses", labels=["cache"])
+        size = GaugeMetricFamily("scholarforge_cache_entries", "Entries held by each in-process cache", labels=["cache"])
+        for cache in self.caches:
+            stats = cache.stats()
+            hits.add_metric([stats["name"]], stats["hits"])
+            misses.add_metric([stats["name"]], stats["misses"])
+            size.add_metric([stats["name"]], stats["size"])
+        yield from (hits, misses, size)
+
+# --- EXPOSITION ---
+def _registry():
+    if not MULTIPROC_DIR: return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+def expose_queue_depth(redis_url: str, queues: list, priority_steps: int):
+    REGISTRY.register(QueueDepthCollector(redis_url, queues, priority_steps))
+
+def expose_caches(caches: list):
+    REGISTRY.register(CacheCollector(caches))
+
+def render() -> tuple[bytes, str]:
+    return generate_latest(_registry()), CONTENT_TYPE_LATEST
+
+def start_worker_exporter():
+    """Serves this worker's metrics on WORKER_METRICS_PORT. Call once, in the parent process."""
+    if MULTIPROC_DIR:
+        for name in os.listdir(MULTIPROC_DIR):
+            os.remove(os.path.join(MULTIPROC_DIR, name))  # samples from a previous run
+    start_http_server(WORKER_METRICS_PORT, registry=_registry())
+    print(f"[metrics] Worker exporter listening on :{WORKER_METRICS_PORT}")
+
+def mark_process_dead(pid: int):
+    if MULTIPROC_DIR: multiprocess.mark_process_dead(pid)
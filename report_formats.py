@@ -57,14 +57,17 @@ def get_template_instructions(format_type: str, page_count: int) -> dict:
     if page_count <= 5:
         tier = "short"
         target_sections = 4
+        time_budget = 240
         complexity_instruction = "Keep the structure concise. Focus only on the most critical high-level points."
     elif page_count <= 12:
         tier = "medium"
         target_sections = 7
+        time_budget = 480
         complexity_instruction = "Standard report depth. Include background, main analysis, and distinct sub-themes."
     else:
         tier = "long"
         target_sections = 10 
+        time_budget = 900
         complexity_instruction = "Comprehensive deep-dive. Add extra sections for Context, Economic Impact, Future Outlook."
 
     selected_template = FORMAT_TEMPLATES.get(format_type, LIT_REVIEW_BASE)
@@ -80,5 +83,6 @@ def get_template_instructions(format_type: str, page_count: int) -> dict:
     return {
         "template_text": final_template,
         "target_sections": target_sections,
-        "tier": tier
+        "tier": tier,
+        "time_budget": time_budget  # seconds of wall-clock the pipeline may spend
     }
\ No newline at end of file
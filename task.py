@@ -1,42 +1,245 @@
 import os
-from celery import Celery
+import json
+import time
+from celery import Celery, chord
+from celery.exceptions import Ignore
+from celery.signals import worker_init, worker_process_init, worker_process_shutdown, before_task_publish, task_prerun, task_postrun
 import AI_engine
+import async_engine
 import database
+import metrics
+import tracing
 
 REDIS_URL = os.environ.get('CELERY_BROKER_URL', 'redis://redis:6379/0')
 
+# "distributed" fans section writing out across the worker fleet; "sequential" keeps a report on one worker;
+# "async" runs many reports per process on a shared event loop (use with a -P threads worker pool).
+REPORT_PIPELINE = os.environ.get('REPORT_PIPELINE', 'distributed')
+
 celery_app = Celery(
     'scholarforge_tasks',
     broker=REDIS_URL,
     backend=REDIS_URL
 )
 
-@celery_app.task(bind=True)
-def generate_report_task(self, query: str, format_content: str, page_count: int):
+# --- QUEUE ROUTING ---
+# Reports are routed by estimated cost (page_count tier) so short jobs never wait behind
+# 30-page ones. Long reports have a pool of their own; short and medium share one (see
+# docker-compose.yml), so within that pool ordering is plain FIFO per queue.
+REPORT_QUEUES = {"short": "reports_short", "medium": "reports_medium", "long": "reports_long"}
+# Redis priorities: 0 is served first. Sections of already-admitted reports jump ahead of
+# new reports in the same queue. Every new report gets the same priority: ranking them by
+# size under the strict priority strategy would let a stream of small jobs starve bigger ones.
+PRIORITY_IN_FLIGHT = 0
+PRIORITY_NEW = 1
+MAX_PRIORITY = 9
+
+def report_route(format_key: str, page_count: int) -> dict:
+    tier = AI_engine.get_template_instructions(format_key, page_count)["tier"]
+    return {"queue": REPORT_QUEUES[tier], "priority": PRIORITY_NEW}
+
+def route_report_task(name, args, kwargs, options, task=None, **kw):
+    if name.endswith("regenerate_section_task"): return {"queue": REPORT_QUEUES["short"]}
+    if not name.endswith("generate_report_task"): return None
+    format_key = args[1] if len(args) > 1 else kwargs.get("format_content")
+    page_count = args[2] if len(args) > 2 else kwargs.get("page_count", 15)
+    return report_route(format_key, page_count)
+
+# Report bodies live in the database; whatever still passes through Redis
+# (progress meta, chord section results) is compressed and expires.
+celery_app.conf.update(
+    result_expires=int(os.environ.get('CELERY_RESULT_EXPIRES', 6 * 3600)),
+    result_compression='gzip',
+    task_routes=(route_report_task,),
+    task_default_queue=REPORT_QUEUES["medium"],
+    # Headroom for the CPU warm-up in worker_process_init (a cold matplotlib font cache is slow).
+    worker_proc_alive_timeout=float(os.environ.get('WORKER_PROC_ALIVE_TIMEOUT', 20)),
+    broker_transport_options={
+        'priority_steps': list(range(MAX_PRIORITY + 1)),
+        'sep': ':',
+        'queue_order_strategy': 'priority'
+    }
+)
+
+# --- WORKER WARM-UP ---
+@worker_process_init.connect
+def warm_up_worker(**kwargs):
+    # Runs once per prefork child, so the first report after a deploy/auto-restart skips cold start.
+    start = time.time()
+    timings = AI_engine.warm_up()
+    details = ", ".join(f"{name}={seconds:.2f}s" for name, seconds in timings.items())
+    print(f"[warm-up] Worker process {os.getpid()} ready in {time.time() - start:.2f}s ({details})")
+    AI_engine.warm_up_network()
+
+# --- METRICS EXPORTER ---
+@worker_init.connect
+def start_metrics_exporter(**kwargs):
+    metrics.start_worker_exporter()
+
+@worker_process_shutdown.connect
+def release_process_metrics(pid=None, **kwargs):
+    metrics.mark_process_dead(pid or os.getpid())
+
+# --- TRACING ---
+# Every published task carries the publisher's traceparent and enqueue time, so chord sections and
+# the assemble callback stay in the /start-report trace and queue wait shows up as its own span.
+_task_spans = {}
+
+def _header(request, name: str):
+    return request.get(name) or (request.get("headers") or {}).get(name)
+
+@before_task_publish.connect
+def inject_trace_headers(headers=None, **kwargs):
+    if headers is not None: tracing.inject(headers)
+
+@task_prerun.connect
+def start_task_span(task_id=None, task=None, **kwargs):
+    parent = tracing.extract(_header(task.request, "traceparent")) or tracing.new_trace()
+    enqueued_at = _header(task.request, "enqueued_at")
+    queue = (task.request.delivery_info or {}).get("routing_key")
+    if enqueued_at:
+        tracing.record_span("celery.queue_wait", float(enqueued_at), time.time(), parent, {"celery.task": task.name, "celery.queue": queue}, kind=5)
+    span = tracing.span(f"celery.task {task.name}", parent, kind=5, **{"celery.task_id": task_id, "celery.queue": queue})
+    span.__enter__()
+    _task_spans[task_id] = span
+
+@task_postrun.connect
+def end_task_span(task_id=None, **kwargs):
+    span = _task_spans.pop(task_id, None)
+    if span: span.__exit__(None, None, None)
+
+def _finish_report(task_id: str, query: str, report_content: str, chart_path: str, degradations: list) -> dict:
+    """Persists the report with its pipeline artifacts and returns only IDs and small metadata."""
+    artifacts = database.get_checkpoints(task_id)
+    report_id = database.save_report(
+        query, report_content,
+        search_content=artifacts.get("search"),
+        summary=artifacts.get("summary"),
+        outline=artifacts.get("outline"),
+        chart_path=chart_path
+    )
+    database.clear_report_state(task_id)
+    return {
+        'status': 'SUCCESS',
+        'report_id': report_id,
+        'topic': query,
+        'chart_path': chart_path,
+        'degradations': degradations
+    }
+
+# acks_late + reject_on_worker_lost: a worker killed mid-report (e.g. watchmedo restart)
+# leaves the message unacked, so it is redelivered under the same task ID and resumes from checkpoints.
+@celery_app.task(bind=True, acks_late=True, reject_on_worker_lost=True)
+def generate_report_task(self, query: str, format_content: str, page_count: int, time_budget: int = None):
     """
-    Sequential Deep Research Task.
-    Takes longer, but produces higher quality output with fewer errors.
+    Deep Research Task.
+    Distributed mode runs research here, then replaces itself with a chord of
+    write_section_task (one per outline entry) feeding assemble_report_task,
+    so the report's sections spread across all idle workers.
     """
     try:
         self.update_state(state='PROGRESS', meta={'message': 'Initializing Deep Research...'})
-        
-        # Run the engine (Sequential Mode)
-        search_content, report_content, chart_path = AI_engine.run_ai_engine_with_return(
-            query, 
-            format_content, 
-            page_count,
-            task=self
-        )
 
-        # Save to DB
+        if REPORT_PIPELINE in ('sequential', 'async') or not query:
+            run_engine = async_engine.run_report if REPORT_PIPELINE == 'async' else AI_engine.run_ai_engine_with_return
+            _, report_content, chart_path, degradations = run_engine(
+                query,
+                format_content,
+                page_count,
+                task=self,
+                time_budget=time_budget
+            )
+            self.update_state(state='PROGRESS', meta={'message': 'Archiving Report...'})
+            return _finish_report(self.request.id, query, report_content, chart_path, degradations)
+
+        format_data = AI_engine.get_template_instructions(format_content, page_count)
+        time_budget = time_budget or format_data["time_budget"]
+
+        checkpointed = AI_engine.checkpointer(self.request.id)
+        progress = AI_engine.ReportProgress(self, format_data["tier"], format_data["target_sections"], section_parallelism=None)
+        with AI_engine.report_budget(time_budget) as budget, AI_engine.cancel_scope(self.request.id):
+            research = AI_engine.run_research_stages(query, format_content, page_count, checkpointed, progress)
+
+        outline = research["outline"]
+        progress.update("section", f"Step 5/6: Researching & Writing 0/{len(outline)}...")
+        # Subtasks stay in this report's queue but ahead of reports that have not started yet.
+        route = {"queue": report_route(format_content, page_count)["queue"], "priority": PRIORITY_IN_FLIGHT}
+        sections = [
+            write_section_task.s(self.request.id, i, len(outline), section, query, research["summary"],
+                                 research["words_per_section"], time_budget, budget.deadline, format_data["tier"]).set(**route)
+            for i, section in enumerate(outline)
+        ]
+        callback = assemble_report_task.s(self.request.id, query, outline, research["chart_path"], budget.degradations).set(**route)
+        # replace() hands our task ID to the chord callback, so /report-status keeps polling the same ID.
+        raise self.replace(chord(sections, callback))
+    except Ignore:
+        raise
+    except AI_engine.ReportCancelled:
+        # The task is acked, so it is never redelivered: its checkpoints cannot be reused.
+        database.clear_report_state(self.request.id)
+        return {'status': 'CANCELLED'}
+    except Exception as e:
+        database.clear_report_state(self.request.id)
+        return {'status': 'FAILURE', 'error': str(e)}
+
+@celery_app.task(bind=True, acks_late=True, reject_on_worker_lost=True)
+def write_section_task(self, report_task_id: str, index: int, total: int, section: str, query: str, summary: str,
+                       words_per_section: int, time_budget: int, deadline: float, tier: str = "long") -> dict:
+    """Writes one outline section of report_task_id under the parent report's deadline."""
+    checkpointed = AI_engine.checkpointer(report_task_id)
+    progress = AI_engine.ReportProgress(self, tier, total, task_id=report_task_id, section_parallelism=None)
+    with AI_engine.report_budget(time_budget, deadline) as budget, AI_engine.cancel_scope(report_task_id):
+        try:
+            AI_engine.check_cancelled(force=True)
+            # Sections run in parallel, so each one may use all of the remaining budget.
+            content = AI_engine.write_report_section(index, section, query, summary, "", words_per_section, 1, checkpointed, progress)
+            done = database.count_checkpoints(report_task_id, "section:")
+            progress.update("section", f"Step 5/6: Researching & Writing... {done}/{total} sections done", sections_done=done)
+        except AI_engine.ReportCancelled:
+            return {'content': '', 'degradations': [], 'cancelled': True}
+    return {'content': content, 'degradations': budget.degradations}
+
+@celery_app.task(bind=True, acks_late=True, reject_on_worker_lost=True)
+def assemble_report_task(self, section_results: list, report_task_id: str, query: str, outline: list, chart_path: str, degradations: list) -> dict:
+    """Chord callback: runs under the original report task ID once every section is written."""
+    try:
+        if any(r.get('cancelled') for r in section_results):
+            database.clear_report_state(report_task_id)  # every section has finished by now
+            return {'status': 'CANCELLED'}
+        self.update_state(state='PROGRESS', meta={'message': 'Step 6/6: Finalizing...', 'stage': 'finalize', 'percent': 99, 'eta_seconds': 0})
+        report_content = AI_engine.assemble_report(query, outline, [r['content'] for r in section_results])
+        for r in section_results:
+            degradations += [d for d in r['degradations'] if d not in degradations]
+
         self.update_state(state='PROGRESS', meta={'message': 'Archiving Report...'})
-        database.save_report(query, report_content)
+        return _finish_report(report_task_id, query, report_content, chart_path, degradations)
+    except Exception as e:
+        database.clear_report_state(report_task_id)
+        return {'status': 'FAILURE', 'error': str(e)}
 
+@celery_app.task(bind=True, acks_late=True, reject_on_worker_lost=True)
+def regenerate_section_task(self, report_id: int, section: str, time_budget: int = None) -> dict:
+    """Rewrites one section of a stored report from its persisted summary and splices it back in place."""
+    try:
+        report = database.get_report_content(report_id, artifacts=True)
+        if not report:
+            return {'status': 'FAILURE', 'error': 'Report not found.'}
+        if not report.summary:
+            return {'status': 'FAILURE', 'error': 'Report has no stored research summary; regenerate the full report.'}
+
+        self.update_state(state='PROGRESS', meta={'message': f'Rewriting section: {section}...', 'stage': 'section', 'sections_total': 1})
+        content, degradations = AI_engine.regenerate_section(
+            report.topic, report.summary, report.content, section, time_budget or AI_engine.SECTION_REGEN_SECONDS,
+            outline=json.loads(report.outline) if report.outline else None
+        )
+        database.update_report_content(report_id, content)
         return {
             'status': 'SUCCESS',
-            'search_content': search_content,
-            'report_content': report_content,
-            'chart_path': chart_path
+            'report_id': report_id,
+            'topic': report.topic,
+            'section': section,
+            'chart_path': report.chart_path,
+            'degradations': degradations
         }
     except Exception as e:
-        return {'status': 'FAILURE', 'error': str(e)}
\ No newline at end of file
+        return {'status': 'FAILURE', 'error': str(e)}
@@ -0,0 +1,120 @@
+import os
+import json
+import time
+import secrets
+import threading
+import contextvars
+from contextlib import contextmanager
+from sqlalchemy import event
+
+# End-to-end report tracing. A trace starts at /start-report and follows the report through
+# Celery (W3C traceparent in the message headers) into every stage, LLM, search, scrape and DB
+# call. Spans are appended to TRACE_EXPORT_PATH as OTLP/JSON lines, one ExportTraceServiceRequest
+# per line, so the OpenTelemetry Collector's otlpjsonfile receiver can ship them anywhere.
+
+# --- CONFIG ---
+TRACE_EXPORT_PATH = os.environ.get("TRACE_EXPORT_PATH", "/app/data/traces.jsonl")  # empty disables tracing
+SERVICE_NAME = os.environ.get("OTEL_SERVICE_NAME", "scholarforge")
+
+_current = contextvars.ContextVar("trace_span", default=None)  # (trace_id, span_id) of the active span
+
+# --- EXPORT ---
+_export_lock = threading.Lock()
+_export_file = None
+_export_pid = None
+
+def _attr(key: str, value) -> dict:
+    if isinstance(value, bool): return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int): return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float): return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+def _export(span: dict):
+    global _export_file, _export_pid
+    line = json.dumps({"resourceSpans": [{
+        "resource": {"attributes": [_attr("service.name", SERVICE_NAME)]},
+        "scopeSpans": [{"scope": {"name": "scholarforge"}, "spans": [span]}]
+    }]})
+    with _export_lock:
+        try:
+            # Reopen after fork so prefork children never share a buffered handle.
+            if _export_file is None or _export_pid != os.getpid():
+                _export_file = open(TRACE_EXPORT_PATH, "a", buffering=1)
+                _export_pid = os.getpid()
+            _export_file.write(line + "\n")
+        except OSError as e:
+            print(f"[tracing] Export failed: {e}")
+
+def record_span(name: str, start: float, end: float, parent: tuple = None, attributes: dict = None,
+                error: str = None, span_id: str = None, kind: int = 1):
+    """Writes a finished span. parent is (trace_id, span_id); without one a new trace is started."""
+    if not TRACE_EXPORT_PATH: return
+    trace_id, parent_id = parent or new_trace()
+    _export({
+        "traceId": trace_id,
+        "spanId": span_id or secrets.token_hex(8),
+        "parentSpanId": parent_id,
+        "name": name,
+        "kind": kind,  # 1 internal, 2 server, 3 client, 4 producer, 5 consumer
+        "startTimeUnixNano": str(int(start * 1e9)),
+        "endTimeUnixNano": str(int(end * 1e9)),
+        "attributes": [_attr(k, v) for k, v in (attributes or {}).items() if v is not None],
+        "status": {"code": 2, "message": error} if error else {"code": 1}
+    })
+
+# --- SPANS ---
+def current() -> tuple:
+    return _current.get()
+
+def new_trace() -> tuple:
+    """Parent for a root span: a fresh trace ID with no parent span."""
+    return (secrets.token_hex(16), "")
+
+@contextmanager
+def span(name: str, parent: tuple = None, kind: int = 1, **attributes):
+    """Times the block as a child of the active span (or of `parent`) and makes it the active span."""
+    parent = parent or _current.get() or new_trace()
+    span_id = secrets.token_hex(8)
+    token = _current.set((parent[0], span_id))
+    start, error = time.time(), None
+    try:
+        yield (parent[0], span_id)
+    except BaseException as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current.reset(token)
+        record_span(name, start, time.time(), parent, attributes, error, span_id, kind)
+
+def child_span(name: str, start: float, end: float, **attributes):
+    """Records an already-timed operation under the active span; a no-op outside a trace."""
+    parent = _current.get()
+    if parent: record_span(name, start, end, parent, attributes, kind=3)
+
+# --- PROPAGATION ---
+def inject(headers: dict):
+    """Adds the active span's W3C traceparent and the enqueue time to outgoing message headers."""
+    parent = _current.get()
+    if parent: headers["traceparent"] = f"00-{parent[0]}-{parent[1]}-01"
+    headers["enqueued_at"] = time.time()
+
+def extract(traceparent: str) -> tuple:
+    try:
+        _, trace_id, span_id, _ = traceparent.split("-")
+        return (trace_id, span_id) if len(trace_id) == 32 and len(span_id) == 16 else None
+    except (AttributeError, ValueError):
+        return None
+
+# --- DATABASE ---
+def instrument_engine(engine):
+    """Every statement executed inside a trace becomes a db.query span."""
+    # Start time on the execution context, not a per-connection stack a failed statement would leave unpopped.
+    @event.listens_for(engine, "before_cursor_execute")
+    def _start(conn, cursor, statement, parameters, context, executemany):
+        if context is not None: context.trace_query_start = time.time()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _stop(conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, "trace_query_start", None)
+        if started is None: return
+        child_span("db.query", started, time.time(), **{"db.statement": statement[:200]})